@@ -0,0 +1,276 @@
+"""
+Benchmarks for the im library, to catch performance regressions in
+the parser, the framing of lines and the dispatch to handlers, and
+end to end against a fake server (See fakeircd.py).
+
+Run with:
+python bench.py [parse|framing|dispatch] [--lines N]
+python bench.py e2e [--clients N] [--rate LINES_PER_SEC] [--duration SECONDS]
+                    [--scenario mixed|privmsg|join|names|who|netsplit|...]
+                    [--replay FILE]
+
+Without an action, the parse, framing and dispatch benchmarks are run.
+"""
+
+from im import irc, irc2num, selector, connection, metrics
+from fakeircd import FakeIRCd, Traffic, Replay
+import sys
+import time
+import optparse
+import resource
+
+SAMPLE = [
+    ':nick!~user@host.example.com PRIVMSG #channel :!remind bob to buy milk',
+    ':nick!~user@host.example.com PRIVMSG #channel :just chatting along here',
+    ':other!other@10.0.0.1 NOTICE Botolf :hello there',
+    ':someone!some@gateway/web/freenode JOIN #channel',
+    ':someone!some@gateway/web/freenode PART #channel :Leaving',
+    ':irc.example.net 353 Botolf = #channel :@op +voice alice bob carol dave',
+    ':irc.example.net 005 Botolf CHANTYPES=# PREFIX=(ov)@+ MODES=4 :are supported by this server',
+    '@time=2011-10-19T16:40:51.620Z;account=bob :bob!b@h PRIVMSG #channel :tagged',
+    ]
+
+class LegacyParsedLine(object):
+    """ParsedLine as it was before it tokenized the line once,
+    kept to compare against."""
+
+    def __init__(self, ircline):
+        self.ircline = ircline.strip()
+
+    def hostmask(self):
+        return self.ircline.split()[0][1:]
+
+    def nick(self):
+        return self.hostmask().split('!')[0].replace('~', '')
+
+    def command(self):
+        com = self.ircline.split()[1]
+        return irc2num.num2rpl.get(com, com)
+
+    def params(self):
+        return ' '.join(self.ircline.split(' ')[2:])
+
+    def message(self):
+        return ' '.join(self.params().split()[1:])[1:]
+
+    def target(self):
+        if self.command() in ('PRIVMSG', 'NOTICE', 'TOPIC',
+                              'JOIN', 'PART', 'KICK'):
+            return self.params().split()[0]
+        else:
+            raise irc.ParseError('Not supported.')
+
+def handlers_pass(parsed):
+    """Query a line the way a handful of example.py style handlers would."""
+
+    for _ in xrange(5):
+        if parsed.command() in ('PRIVMSG', 'NOTICE'):
+            parsed.message().startswith('!remind')
+        parsed.nick()
+    if parsed.command() in ('PRIVMSG', 'NOTICE', 'JOIN', 'PART'):
+        parsed.target()
+
+def bench_parse(cls, count):
+    """Return lines/sec for parsing and querying count lines with cls."""
+
+    lines = (SAMPLE * (count // len(SAMPLE) + 1))[:count]
+    start = time.time()
+    for line in lines:
+        handlers_pass(cls(line))
+    return count / (time.time() - start)
+
+class Counter(connection.LineReciever):
+    """Counts the lines framed, and does nothing else."""
+
+    def __init__(self):
+        connection.LineReciever.__init__(self, 'bench', 0, lambda: None)
+        self.lines = 0
+
+    def handle_lines(self, lines):
+        self.lines += len(lines)
+
+def bench_framing(count, chunk=4096):
+    """Return lines/sec for splitting count lines, arriving in
+    chunk sized reads, into lines."""
+
+    data = ''.join(line + '\r\n' for line in
+                   (SAMPLE * (count // len(SAMPLE) + 1))[:count])
+    counter = Counter()
+    start = time.time()
+    for offset in xrange(0, len(data), chunk):
+        counter.feed(data[offset:offset + chunk])
+    elapsed = time.time() - start
+    assert counter.lines == count
+    return count / elapsed
+
+class BenchState(object):
+    """A state for the bots of the benchmarks."""
+
+    def __init__(self, number=0):
+        self.number = number
+        self.lines = 0
+        self.done = False
+        self.latency = metrics.Histogram()
+        self.names = set()
+        self.seen = {}
+        self.messages = {}
+
+    def nick(self):
+        return 'Bench%d' % self.number
+
+    def user(self):
+        return 'bench'
+
+    def ircname(self):
+        return 'Benchmark bot'
+
+class Handler(object):
+    """A handler made from a function, like example.Handler."""
+
+    def __init__(self, run, **attributes):
+        self.run = run
+        self.__dict__.update(attributes)
+
+def measure(line, state, bot):
+    """Count the line, and how long ago the server sent it."""
+
+    state.lines += 1
+    if line.rawtags is not None:
+        sent = line.tags().get('t')
+        if sent:
+            state.latency.observe(time.time() - float(sent))
+    if line.verb == 'ERROR':
+        state.done = True
+
+def remember(line, state, bot):
+    if len(line.cmdargs) > 1:
+        nick = line.cmdargs[0]
+        state.messages.setdefault(nick, []).append(' '.join(line.cmdargs[1:]))
+
+def names(line, state, bot):
+    state.names.update(line.message().split())
+
+def seen(line, state, bot):
+    state.seen[line.nick()] = line.command()
+
+def ignore(line, state, bot):
+    pass
+
+def handlers():
+    """Handlers like those of a typical bot: one seeing every line,
+    one with a trigger that shows up in the traffic, several with
+    triggers that don't, and a few keeping track of people."""
+
+    found = [Handler(measure),
+             Handler(remember, triggers=['!remind']),
+             Handler(names, commands=('RPL_NAMREPLY',)),
+             Handler(seen, commands=('JOIN', 'PART', 'QUIT', 'NICK'))]
+    for trigger in ('!join', '!part', '!seen', '!tell', '!weather', '!quote'):
+        found.append(Handler(ignore, triggers=[trigger]))
+    return found
+
+def bench_dispatch(count):
+    """Return lines/sec for handling count lines with an IRCProtocol,
+    from parsing to running the handlers."""
+
+    lines = (SAMPLE * (count // len(SAMPLE) + 1))[:count]
+    bot = irc.IRCProtocol('bench', 0, lambda: None, connection.nonlogger('bench'))
+    bot.set_state(BenchState())
+    bot.set_handlers(handlers())
+    # As if registered, which is where a bot spends its time.
+    bot.phase = irc.READY
+    bot.nickname = bot.state.nick()
+    start = time.time()
+    bot.handle_lines(lines)
+    return count / (time.time() - start)
+
+class BenchClient(irc.IRCProtocol):
+    """A bot that gives up when the fake server hangs up."""
+
+    def retry(self):
+        return False
+
+def maxrss():
+    """Peak memory use of this process, in megabytes."""
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def bench_e2e(clients, rate, duration, traffic):
+    """Serve traffic (A callable returning a fakeircd.Traffic or Replay)
+    to clients bots on one selector.Reactor, at rate lines/sec per bot
+    (0 for as fast as possible) for duration seconds. Prints lines/sec,
+    latency percentiles and memory use."""
+
+    server = FakeIRCd(traffic, rate, duration)
+    server.start()
+    before = maxrss()
+    bots = []
+    for number in range(clients):
+        bot = BenchClient('127.0.0.1', server.port, log=connection.nonlogger('bench'))
+        bot.set_state(BenchState(number))
+        bot.set_handlers(handlers())
+        bot.register()
+        bots.append(bot)
+    reactor = selector.Reactor(bots)
+    start = time.time()
+    deadline = start + duration + 30
+    try:
+        while reactor.clients and time.time() < deadline:
+            reactor.tick(1)
+    finally:
+        server.stop()
+    elapsed = time.time() - start
+    latency = metrics.Histogram()
+    for bot in bots:
+        for bucket, seen in bot.state.latency.counts.items():
+            latency.counts[bucket] = latency.counts.get(bucket, 0) + seen
+        latency.count += bot.state.latency.count
+        latency.sum += bot.state.latency.sum
+    total = sum(bot.state.lines for bot in bots)
+    print 'End to end, %d clients, %s lines/sec each, %.1f seconds' % (
+        clients, rate or 'unlimited', duration)
+    print '  lines:      %10d (%d clients finished)' % (
+        total, sum(bot.state.done for bot in bots))
+    print '  throughput: %10.0f lines/sec' % (total / elapsed)
+    for q in (0.5, 0.9, 0.99, 0.999, 1.0):
+        print '  p%-9s %10.3f ms' % (repr(q * 100).rstrip('0').rstrip('.') + ':',
+                                     latency.quantile(q) * 1000)
+    print '  max rss:    %10.1f MB (%.1f MB before connecting)' % (maxrss(), before)
+
+def main(args):
+    """Run the benchmarks."""
+
+    parser = optparse.OptionParser(usage='%prog [parse|framing|dispatch|e2e] [options]')
+    parser.add_option('--lines', type='int', default=200000)
+    parser.add_option('--clients', type='int', default=10)
+    parser.add_option('--rate', type='float', default=0)
+    parser.add_option('--duration', type='float', default=5)
+    parser.add_option('--scenario', default='mixed')
+    parser.add_option('--replay')
+    options, args = parser.parse_args(args)
+    actions = args or ['parse', 'framing', 'dispatch']
+    count = options.lines
+    for action in actions:
+        if action == 'parse':
+            before = bench_parse(LegacyParsedLine, count)
+            after = bench_parse(irc.ParsedLine, count)
+            print 'ParsedLine, %d lines' % count
+            print '  before: %10.0f lines/sec' % before
+            print '  after:  %10.0f lines/sec (%.1fx)' % (after, after / before)
+        elif action == 'framing':
+            print 'Framing, %d lines' % count
+            print '  %10.0f lines/sec' % bench_framing(count)
+        elif action == 'dispatch':
+            print 'Dispatch, %d lines' % count
+            print '  %10.0f lines/sec' % bench_dispatch(count)
+        elif action == 'e2e':
+            if options.replay:
+                traffic = lambda: Replay(options.replay)
+            else:
+                traffic = lambda: Traffic(options.scenario)
+            bench_e2e(options.clients, options.rate, options.duration, traffic)
+        else:
+            parser.error('Unknown benchmark: %s' % action)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
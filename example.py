@@ -2,7 +2,7 @@
 Example on how to use the im library to write a bot program.
 """
 
-from im import selector, irc
+from im import selector, irc, casemap
 import sys
 
 class BotState(object):
@@ -22,6 +22,9 @@ class BotState(object):
         self._ircname = ircname
         self.current_nick = 0
         self.messages = {} # For a handler we'll write.
+        # IRC nicks ignore case (And [] is the upper case of {} on most
+        # servers), so we key messages by nick folded like the server does.
+        self.fold = casemap.Casemap()
         
     def nick(self):
         
@@ -47,62 +50,64 @@ class BotState(object):
 class Handler(object):
     """Generic handler class."""
     
-    def __init__(self, interested, run):
-        """Takes two callables as arguments."""
+    def __init__(self, interested, run, commands=None, triggers=None):
+        """Takes two callables as arguments. interested may be None
+        when commands and triggers tell the client enough about which
+        lines we want (And then it can find us with a dict lookup)."""
         
-        self.interested = interested
+        if interested is not None:
+            self.interested = interested
         self.run = run
-
-def interested_rem(line, state):
-    """Are we interested in saving a reminder?"""
-    
-    return line.command() in ('PRIVMSG', 'NOTICE') and line.message().startswith('!remind')
+        if commands is not None:
+            self.commands = commands
+        if triggers is not None:
+            self.triggers = triggers
 
 def remember(line, state, sockwriter):
     """Remember this message for someone (Or help them figure out how this works."""
     
-    if len(line.message().split()) < 3:
+    # The words after !remind, split up for us by the client.
+    args = line.cmdargs
+    if len(args) < 2:
         sockwriter.nreply('Usage: !remind <nick> <message>')
     else:
-        nick = line.message().split()[1]
-        message = ' '.join(line.message().split()[2:])
-        state.messages[nick] = state.messages.get(nick, []) + [(line.nick(), message)]
+        nick = args[0]
+        message = ' '.join(args[1:])
+        key = state.fold(nick)
+        state.messages[key] = state.messages.get(key, []) + [(line.nick(), message)]
         sockwriter.nreply('Will remind %s about %s.' % (nick, message))
 
-# We now have a handler for saving reminders.
-reminder = Handler(interested_rem, remember)
-
-def interested_join(line, state):
-    """Is someone asking us to join a channel?"""
-    
-    return line.command() in ('PRIVMSG', 'NOTICE') and line.message().startswith('!join')
+# We now have a handler for saving reminders. It only cares
+# about PRIVMSG and NOTICE lines starting with !remind.
+reminder = Handler(None, remember, ('PRIVMSG', 'NOTICE'), ['!remind'])
 
 def join(line, state, sockwriter):
     """Join the channel, or tell the someone how to use our command."""
     
-    if len(line.message().split()) < 2:
+    args = line.cmdargs
+    if len(args) < 1:
         sockwriter.nreply('Usage: !join <channel> [<key>]')
     else:
-        channel = line.message().split()[1]
-        if len(line.message().split()) == 3:
-            key = line.message().split()[2]
+        channel = args[0]
+        if len(args) == 2:
+            key = args[1]
         else:
             key = ""
         sockwriter.join(channel, key)
 
 # We now have a handler for joining channels.
-joiner = Handler(interested_join, join)
+joiner = Handler(None, join, ('PRIVMSG', 'NOTICE'), ['!join'])
 
 def interested_tell(line, state):
     """Do we have any reminders for this person?"""
     
-    return line.nick() in state.messages
+    return state.fold(line.nick()) in state.messages
 
 def tell(line, state, sockwriter):
     """Give the reminders to the person."""
     
     nick = line.nick()
-    messages = state.messages.pop(nick)
+    messages = state.messages.pop(state.fold(nick))
     for sender, message in messages:
         sockwriter.notice(nick, '%s told me to remind you about %s' % (sender, message))
 
@@ -128,15 +133,22 @@ if __name__ == '__main__':
     
         port = 6667
         if len(sys.argv) < 2:
-            print 'Usage: python example.py server1 <server2 ...>'
+            print 'Usage: python example.py server1 <server2 ...> [#channel ...]'
             sys.exit()
-        hosts = sys.argv[1:] # For ever command line argument, we'll make an irc client.
+        # For every server on the command line, we'll make an irc client,
+        # and they'll all join the channels on the command line.
+        hosts = [arg for arg in sys.argv[1:] if not arg.startswith('#')]
+        channels = [arg for arg in sys.argv[1:] if arg.startswith('#')]
         clients = [irc.IRCProtocol(host, port, log=log) for host in hosts] # All connect to 6667
         state = BotState(['IRCBot', 'Botolf'], 'Botolf', 'This is a bot') # They all use the same nick, user and ircname.
         for client in clients:
             client.set_state(state) # Tell the client about it's nick and things like that.
             client.set_handlers([reminder, joiner, teller]) # Add functionality to the client.
-            client.register() # Run it.
+            client.set_autojoin(channels) # Join these once the server welcomes us.
         reactor = selector.Reactor(clients)
+        for client in clients:
+            # Start connecting. This doesn't wait, the reactor connects and
+            # registers all the clients at once (Trying the next nick from
+            # state if one is taken), so no slow server holds up the others.
+            client.register()
         reactor.loop() # Loop indefinitely.
-
@@ -0,0 +1,202 @@
+"""
+A fake IRC server for benchmarks, and a generator of realistic
+traffic for it to send.
+
+The server runs in a separate process, so it doesn't compete with
+the client being measured for the interpreter. It welcomes each
+client, then streams generated (Or replayed) lines at it, at a
+configurable rate, for a configurable time, and says ERROR :done.
+Every line gets a t tag with the time it was sent, so the client can
+measure latency.
+
+See bench.py for how it's used.
+"""
+
+import time
+import random
+import select
+import socket
+import threading
+import multiprocessing
+
+SERVER = 'fake.ircd'
+
+class Traffic(object):
+    """Generates lines like those seen in busy channels."""
+
+    # How often each kind of traffic shows up in the mixed scenario.
+    MIX = (('privmsg', 70), ('command', 10), ('join', 8), ('part', 6),
+           ('names', 2), ('who', 2), ('netsplit', 1), ('nick', 1))
+
+    def __init__(self, scenario='mixed', channels=20, nicks=2000, me='Botolf', seed=None):
+        """scenario is mixed, or one of the kinds in MIX. The traffic
+        is spread over channels channels and nicks nicks. me is the
+        nick of the client."""
+
+        self.random = random.Random(seed)
+        self.scenario = scenario
+        self.channels = ['#chan%d' % number for number in range(channels)]
+        self.nicks = ['nick%d' % number for number in range(nicks)]
+        self.me = me
+        kinds = []
+        for kind, weight in self.MIX:
+            kinds.extend([kind] * weight)
+        self.kinds = kinds
+
+    def mask(self, nick):
+        """A hostmask for nick."""
+
+        return '%s!~%s@host-%d.example.com' % (nick, nick, hash(nick) % 1000)
+
+    def pick(self):
+        """A random nick and channel."""
+
+        return self.random.choice(self.nicks), self.random.choice(self.channels)
+
+    def lines(self):
+        """Yield lines forever."""
+
+        while True:
+            if self.scenario == 'mixed':
+                kind = self.random.choice(self.kinds)
+            else:
+                kind = self.scenario
+            for line in getattr(self, kind)():
+                yield line
+
+    def privmsg(self):
+        nick, channel = self.pick()
+        words = ' '.join(self.random.choice(self.nicks) for _ in range(self.random.randint(3, 20)))
+        yield ':%s PRIVMSG %s :%s' % (self.mask(nick), channel, words)
+
+    def command(self):
+        nick, channel = self.pick()
+        other = self.random.choice(self.nicks)
+        yield ':%s PRIVMSG %s :!remind %s to check the logs' % (self.mask(nick), channel, other)
+
+    def join(self):
+        nick, channel = self.pick()
+        yield ':%s JOIN %s' % (self.mask(nick), channel)
+
+    def part(self):
+        nick, channel = self.pick()
+        yield ':%s PART %s :Leaving' % (self.mask(nick), channel)
+
+    def nick(self):
+        nick, channel = self.pick()
+        yield ':%s NICK :%s_' % (self.mask(nick), nick)
+
+    def names(self):
+        channel = self.random.choice(self.channels)
+        for start in range(0, len(self.nicks), 40):
+            names = ' '.join(self.nicks[start:start + 40])
+            yield ':%s 353 %s = %s :%s' % (SERVER, self.me, channel, names)
+        yield ':%s 366 %s %s :End of /NAMES list.' % (SERVER, self.me, channel)
+
+    def who(self):
+        channel = self.random.choice(self.channels)
+        for nick in self.random.sample(self.nicks, min(200, len(self.nicks))):
+            yield ':%s 352 %s %s ~%s host.example.com %s %s H :0 %s' % (
+                SERVER, self.me, channel, nick, SERVER, nick, nick)
+        yield ':%s 315 %s %s :End of /WHO list.' % (SERVER, self.me, channel)
+
+    def netsplit(self):
+        split = self.random.sample(self.nicks, min(300, len(self.nicks)))
+        for nick in split:
+            yield ':%s QUIT :*.net *.split' % self.mask(nick)
+        for nick in split:
+            yield ':%s JOIN %s' % (self.mask(nick), self.random.choice(self.channels))
+
+class Replay(object):
+    """Traffic replayed from a file of raw IRC lines, over and over."""
+
+    def __init__(self, path):
+        """Read the lines in path."""
+
+        self.recorded = [line.rstrip('\r\n') for line in open(path) if line.strip()]
+
+    def lines(self):
+        """Yield lines forever."""
+
+        while True:
+            for line in self.recorded:
+                yield line
+
+class FakeIRCd(object):
+    """Serves traffic to clients from another process."""
+
+    def __init__(self, traffic, rate=0, duration=5.0, host='127.0.0.1', port=0):
+        """traffic is a callable returning a Traffic or Replay, called
+        for each client. rate is lines per second per client, or 0 for
+        as fast as possible. Every client is served for duration
+        seconds. port 0 picks a free port, see self.port."""
+
+        self.traffic = traffic
+        self.rate = rate
+        self.duration = duration
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        self.process = None
+
+    def start(self):
+        """Start serving in another process."""
+
+        self.process = multiprocessing.Process(target=self.serve)
+        self.process.daemon = True
+        self.process.start()
+        self.sock.close()
+
+    def stop(self):
+        """Stop serving."""
+
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+
+    def serve(self):
+        """Accept clients forever, serving each from a thread."""
+
+        while True:
+            conn, _ = self.sock.accept()
+            session = threading.Thread(target=self.session, args=(conn,))
+            session.daemon = True
+            session.start()
+
+    def session(self, conn):
+        """Welcome the client on conn and send it traffic."""
+
+        data = ''
+        while 'NICK ' not in data:
+            chunk = conn.recv(4096)
+            if not chunk:
+                return
+            data += chunk
+        nick = data.split('NICK ', 1)[1].split()[0]
+        conn.sendall(':%s 001 %s :Welcome to the benchmark\r\n' % (SERVER, nick))
+        lines = self.traffic().lines()
+        start = time.time()
+        sent = 0
+        while True:
+            now = time.time()
+            if now - start >= self.duration:
+                break
+            if self.rate:
+                due = min(int(self.rate * (now - start)) - sent, 1000)
+            else:
+                due = 256
+            if due <= 0:
+                time.sleep(0.001)
+                continue
+            stamp = '@t=%.6f ' % now
+            batch = [stamp + lines.next() for _ in xrange(due)]
+            conn.sendall('\r\n'.join(batch) + '\r\n')
+            sent += due
+            # Throw away whatever the client says, so it's never blocked.
+            while select.select([conn], [], [], 0)[0]:
+                if not conn.recv(65536):
+                    return
+        conn.sendall('ERROR :done\r\n')
+        conn.close()
@@ -4,12 +4,26 @@ connected to a server. It was written with IRC in mind, so it's not
 very generic, in that it pretty much assumes a single client connected
 to a central server, and it's not easy for a client to add further connections
 at runtime (But possible, though you might have to avoid selector.Reactor.loop.
+To run many connections, spread them over several reactors with shard.Supervisor.
 """
 
 __all__ = [
     "irc",
     "selector",
     "connection",
-    "irc2num"
+    "irc2num",
+    "flood",
+    "router",
+    "workers",
+    "logs",
+    "wirelog",
+    "metrics",
+    "profiling",
+    "shard",
+    "scheduler",
+    "resolver",
+    "tracker",
+    "casemap",
+    "isupport"
     ]
 
@@ -0,0 +1,370 @@
+"""
+This module runs the clients of this library on an asyncio event
+loop, instead of selector.Reactor. Handlers may then be coroutines,
+and wait for database calls or HTTP lookups without stalling the
+other connections.
+
+This library is Python 2, so that means trollius (The backport of
+asyncio, 2.1 or later for ensure_future), not asyncio itself: its
+coroutines are generators decorated with trollius.coroutine, which
+wait with yield From(...), not async def and await. uvloop is
+Python 3 only, so trollius' own event loops are all there is.
+
+Usage is the same as with selector.Reactor:
+
+    client = aio.AsyncIRCProtocol(host, 6667)
+    reactor = aio.AsyncReactor([client])
+    client.register()
+    reactor.loop()
+
+The event loop resolves and connects, but the clients decide when to
+connect again, as they do on selector.Reactor (See connection.Backoff).
+Other connection.LineReciever subclasses can run on it by mixing in
+AsyncClient.
+"""
+
+import trollius as asyncio
+
+import time
+import errno
+import socket
+
+from irc import IRCProtocol
+from connection import IDLE, CONNECTING, CONNECTED
+
+class TransportSocket(object):
+    """Looks enough like a non-blocking socket for
+    connection.BufferedSockWriter to write to an asyncio transport."""
+
+    def __init__(self, transport):
+        """Wrap transport."""
+
+        self.transport = transport
+
+    def send(self, data):
+        """Write data. The transport buffers what it can't write yet."""
+
+        self.transport.write(data)
+        return len(data)
+
+    def fileno(self):
+        """fd of the underlying socket, or -1."""
+
+        sock = self.transport.get_extra_info('socket')
+        if sock is None:
+            return -1
+        return sock.fileno()
+
+    def setblocking(self, flag):
+        """Transports are always non-blocking."""
+
+        pass
+
+    def close(self):
+        """Close the transport."""
+
+        self.transport.close()
+
+class LineProtocol(asyncio.Protocol):
+    """asyncio.Protocol that feeds a connection.LineReciever (Or
+    subclass) with what the transport reads, and flushes its output
+    when it asks the reactor to."""
+
+    def __init__(self, client, reactor):
+        """client is fed, reactor is the AsyncReactor it belongs to."""
+
+        self.client = client
+        self.reactor = reactor
+        self.transport = None
+        self.paused = False
+        self.scheduled = False
+
+    def connection_made(self, transport):
+        """Let the client greet the server."""
+
+        self.transport = transport
+        self.reactor.made(self.client, self)
+
+    def data_received(self, data):
+        """Hand data to the client."""
+
+        try:
+            self.client.feed(data)
+        except (IOError, socket.error), err:
+            self.reactor.failed(self.client, err)
+        except Exception, err:
+            self.reactor.log(err)
+
+    def connection_lost(self, exc):
+        """Tell the reactor, so the client can reconnect."""
+
+        self.reactor.lost(self.client, self, exc)
+
+    def pause_writing(self):
+        """The transport has buffered too much, stop flushing."""
+
+        self.paused = True
+
+    def resume_writing(self):
+        """The transport has room for more."""
+
+        self.paused = False
+        self.schedule()
+
+    def schedule(self):
+        """Flush the output of the client soon, if it has any."""
+
+        if self.scheduled or self.paused or not self.client.wants_write():
+            return
+        self.scheduled = True
+        self.reactor.eventloop.call_soon(self.flush)
+
+    def flush(self):
+        """Let the client write what it's allowed to."""
+
+        self.scheduled = False
+        if not self.paused and self.client.wants_write():
+            self.client.do_write()
+
+class Periodic(object):
+    """A call repeated on an event loop, like
+    scheduler.TimerHandle for selector.Reactor.call_every."""
+
+    def __init__(self, eventloop, interval, callback, args):
+        self.eventloop = eventloop
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.handle = eventloop.call_later(interval, self.run)
+
+    def run(self):
+        self.handle = self.eventloop.call_later(self.interval, self.run)
+        self.callback(*self.args)
+
+    def cancel(self):
+        """Stop making the call."""
+
+        self.cancelled = True
+        self.handle.cancel()
+
+class AsyncClient(object):
+    """Mix in before connection.LineReciever (Or a subclass) to connect
+    through the event loop of an AsyncReactor, instead of with a socket
+    of its own. Reconnecting works as it does on selector.Reactor."""
+
+    def connect(self):
+        """Have the reactor resolve the destination and connect to
+        it, giving up after connect_timeout seconds."""
+
+        if self.reactor is None or self not in self.reactor.clients:
+            # Removed while waiting to reconnect.
+            self.status = IDLE
+            return
+        self.status = CONNECTING
+        task = self.reactor.connect(self)
+        self.timer = self.reactor.call_later(self.connect_timeout, task.cancel)
+
+    def made(self, sock):
+        """The reactor connected us, sock (A TransportSocket) writes
+        to the connection."""
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.sock = sock
+        self.status = CONNECTED
+        self.since = time.time()
+        self.connected()
+
+class AsyncReactor(object):
+    """Does the work of selector.Reactor on an asyncio event loop.
+    Clients see the same interface (want_write, reregister, call_later
+    and the like), so an AsyncClient works on either."""
+
+    def __init__(self, clients=None, logger=None, loop=None):
+        """clients and logger are as for selector.Reactor. loop is
+        the event loop to use, the current one if None."""
+
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.eventloop = loop
+        self.logger = logger
+        self.clients = []
+        self.protocols = {}
+        self.connecting = {}
+        if clients is not None:
+            for client in clients:
+                self.addclient(client)
+
+    def addclient(self, client):
+        """Add a client to this reactor. It connects once registered."""
+
+        self.clients.append(client)
+        if hasattr(client, 'set_reactor'):
+            client.set_reactor(self)
+
+    def removeclient(self, client):
+        """Remove a client from this reactor, and disconnect it."""
+
+        self.clients.remove(client)
+        task = self.connecting.pop(client, None)
+        if task is not None:
+            task.cancel()
+        protocol = self.protocols.pop(client, None)
+        if protocol is not None:
+            protocol.transport.close()
+
+    def add_client(self, client):
+        """Add a client to this reactor, from any thread."""
+
+        self.call_soon_threadsafe(self.addclient, client)
+
+    def remove_client(self, client):
+        """Remove a client from this reactor, from any thread."""
+
+        self.call_soon_threadsafe(self.discard, client)
+
+    def discard(self, client):
+        """Remove client, if it's still a client of this reactor."""
+
+        if client in self.clients:
+            self.removeclient(client)
+
+    def connect(self, client):
+        """Start connecting client (See AsyncClient.connect).
+        Returns the task doing it."""
+
+        factory = lambda: LineProtocol(client, self)
+        connecting = self.eventloop.create_connection(factory, client.dst, client.port)
+        task = self.connecting[client] = asyncio.ensure_future(connecting, loop=self.eventloop)
+        task.add_done_callback(lambda task: self.connect_done(client, task))
+        return task
+
+    def connect_done(self, client, task):
+        """Tell client if connecting failed or timed out."""
+
+        if self.connecting.get(client) is task:
+            del self.connecting[client]
+        if client not in self.clients or client.status != CONNECTING:
+            return
+        if task.cancelled():
+            client.connect_failed(socket.error(errno.ETIMEDOUT, 'Connect timed out'))
+        elif task.exception() is not None:
+            client.connect_failed(task.exception())
+
+    def made(self, client, protocol):
+        """protocol connected client."""
+
+        if client not in self.clients or client.status != CONNECTING:
+            # Removed, or timed out, while connecting.
+            protocol.transport.close()
+            return
+        self.protocols[client] = protocol
+        client.made(TransportSocket(protocol.transport))
+        protocol.schedule()
+
+    def failed(self, client, error):
+        """The connection of client failed with error. Let the client
+        retry, as selector.Reactor does, or drop it if it won't."""
+
+        self.log(error)
+        protocol = self.protocols.pop(client, None)
+        if protocol is not None:
+            protocol.transport.close()
+        if not client.retry():
+            self.discard(client)
+
+    def lost(self, client, protocol, exc):
+        """The connection of client by protocol was closed. Unless
+        we closed it (Or the client did, see reregister), it failed."""
+
+        if self.protocols.get(client) is not protocol:
+            return
+        if exc is None:
+            exc = socket.error(errno.ECONNRESET, 'Connection closed by peer')
+        self.failed(client, exc)
+
+    def reregister(self, client):
+        """The connection of client changed. The event loop watches
+        transports by itself, so this only closes the transport of a
+        client that hung up."""
+
+        if client.id() is None:
+            protocol = self.protocols.pop(client, None)
+            if protocol is not None:
+                protocol.transport.close()
+
+    def want_write(self, client, flag=True):
+        """Flush the output of client soon, if flag is set."""
+
+        protocol = self.protocols.get(client)
+        if flag and protocol is not None:
+            protocol.schedule()
+
+    def call_later(self, delay, callback, *args):
+        """Call callback with args after delay seconds."""
+
+        return self.eventloop.call_later(delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        """Call callback with args at time when (As returned by
+        time.time, not the clock of the event loop)."""
+
+        return self.call_later(max(when - time.time(), 0), callback, *args)
+
+    def call_every(self, interval, callback, *args):
+        """Call callback with args every interval seconds, until
+        the returned handle is cancelled."""
+
+        return Periodic(self.eventloop, interval, callback, args)
+
+    def call_soon(self, callback, *args):
+        """Call callback with args soon, on the event loop."""
+
+        return self.eventloop.call_soon(callback, *args)
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Call callback with args soon, on the event loop,
+        from any thread."""
+
+        return self.eventloop.call_soon_threadsafe(callback, *args)
+
+    def spawn(self, coroutine):
+        """Run coroutine as a task, logging it if it fails."""
+
+        task = asyncio.ensure_future(coroutine, loop=self.eventloop)
+        task.add_done_callback(self.reap)
+        return task
+
+    def reap(self, task):
+        """Log the exception of a finished task, if any."""
+
+        if not task.cancelled() and task.exception() is not None:
+            self.log(task.exception())
+
+    def log(self, event):
+        """Log event."""
+
+        if self.logger:
+            self.logger(event)
+
+    def loop(self):
+        """Run the event loop forever."""
+
+        self.eventloop.run_forever()
+
+class AsyncIRCProtocol(AsyncClient, IRCProtocol):
+    """An irc.IRCProtocol whose handlers may be coroutines (Their run
+    is a trollius coroutine). They run as tasks on the event loop of the
+    AsyncReactor, so they must not rely on self.line or reply once
+    they've waited for something, as other lines may have arrived by then;
+    use the line they were given instead."""
+
+    def run_handler(self, handler, line):
+        """Run handler, as a task if it's a coroutine."""
+
+        result = IRCProtocol.run_handler(self, handler, line)
+        if asyncio.iscoroutine(result):
+            return self.reactor.spawn(result)
+        return result
@@ -0,0 +1,65 @@
+"""
+This module compares nicks and channel names the way the server
+does. IRC servers fold case by one of the mappings they advertise in
+ISUPPORT CASEMAPPING:
+
+ascii - A-Z are the upper case of a-z.
+rfc1459 - so are []\\~ of {}|^ (The default).
+strict-rfc1459 - like rfc1459, without ~ and ^.
+
+A Casemap folds names with a precomputed translation table, and keeps
+the folded, interned keys of the names it saw last, so folding a nick
+that's already known is a dict lookup.
+"""
+
+import string
+
+UPPER = string.ascii_uppercase
+LOWER = string.ascii_lowercase
+
+TABLES = {
+    'ascii': string.maketrans(UPPER, LOWER),
+    'rfc1459': string.maketrans(UPPER + '[]\\~', LOWER + '{}|^'),
+    'strict-rfc1459': string.maketrans(UPPER + '[]\\', LOWER + '{}|'),
+    }
+
+DEFAULT = 'rfc1459'
+
+class Casemap(object):
+    """Folds names by a casemapping, remembering the keys of the most
+    recently used names (Approximately: when size names have been
+    folded, those not used since the last time are forgotten)."""
+
+    def __init__(self, name=DEFAULT, size=4096):
+        """name is one of the mappings in TABLES; unknown ones are
+        taken to be rfc1459, as the RFC says."""
+
+        if name not in TABLES:
+            name = DEFAULT
+        self.name = name
+        self.table = TABLES[name]
+        self.size = size
+        self.recent = {}
+        self.older = {}
+
+    def __call__(self, name):
+        """The key of name: folded, and interned."""
+
+        key = self.recent.get(name)
+        if key is not None:
+            return key
+        key = self.older.get(name)
+        if key is None:
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            key = intern(name.translate(self.table))
+        if len(self.recent) >= self.size:
+            self.older = self.recent
+            self.recent = {}
+        self.recent[name] = key
+        return key
+
+    def equal(self, first, second):
+        """Are first and second the same name?"""
+
+        return first == second or self(first) == self(second)
@@ -3,12 +3,60 @@ This module provides a few baseclasses for basic
 line-terminated protocols, for use with selector.Reactor.
 """
 
+import os
 import socket
-import datetime
 import time
+import errno
+import random
+import collections
+
+from flood import FloodControl
+from logs import Logger
+import resolver
+import metrics
 
 CRLF = '\r\n'
 LF = '\n'
+BUFSIZE = 4096
+# The longest line kept: IRCv3 tags, and the 512 bytes of the line.
+MAXLINE = 8191 + 512
+WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+INPROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, errno.EINTR)
+
+# What a LineReciever is up to.
+IDLE = 'idle'
+RESOLVING = 'resolving'
+CONNECTING = 'connecting'
+CONNECTED = 'connected'
+WAITING = 'waiting'
+
+class Backoff(object):
+    """Delays between reconnects, growing exponentially up to
+    maximum, with random jitter so clients that lost their connections
+    at the same time don't all come back at once."""
+
+    def __init__(self, initial=1.0, maximum=300.0, factor=2.0, jitter=0.5):
+        """The first delay is initial seconds, each following one factor
+        times the last, up to maximum. Delays are shortened by a random
+        fraction of up to jitter."""
+
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.reset()
+
+    def reset(self):
+        """Start over from initial."""
+
+        self.current = self.initial
+
+    def next(self):
+        """The next delay, in seconds."""
+
+        delay = self.current
+        self.current = min(self.current * self.factor, self.maximum)
+        return delay * (1 - random.random() * self.jitter)
 
 class LineReciever(object):
     """Baseclass for a client which can connect to a server, and deals
@@ -20,38 +68,318 @@ class LineReciever(object):
         port - TCP port number,
         sockmaker - a factory for sockets. Useful for testing,
                     by writing a mocksocket object. Needs
-                    support for fileno, and recv.
+                    support for fileno, setblocking, connect_ex,
+                    getsockopt, close and recv_into.
         Methods that should be overriden:
-        handle_line
-        register (Needs to connect the socket)
-        retry.
+        handle_line (or handle_lines)
+        retry (Calling reconnect, to connect again).
         """
         
         self.sock = sockmaker()
         self.sockmaker = sockmaker
         self.dst, self.port = destination, port
-        self.buf = ""
+        self.reactor = None
+        self.resolver = resolver.default
+        self.backoff = Backoff()
+        self.status = IDLE
+        self.wanted = False
+        self.addresses = []
+        self.timer = None
+        self.since = 0
+        self.connect_timeout = 30
+        # Connections that lasted this long reset the backoff.
+        self.stable = 60
+        self.name = '%s:%s' % (destination, port)
         self.term = CRLF
-        self.buf = None
+        self.rxbytes = metrics.registry.counter(
+            'connection_received_bytes_total', 'Bytes received.', conn=self.name)
+        self.rxlines = metrics.registry.counter(
+            'connection_received_lines_total', 'Lines received.', conn=self.name)
+        # Kept even when metrics are off, to balance shards (See shard).
+        self.received = 0
+        self.buf = bytearray(BUFSIZE)
+        self.view = memoryview(self.buf)
+        self.buflen = 0
+        # Set while throwing away the rest of a line over MAXLINE.
+        self.overlong = False
         
     def id(self):
-        """Return fd of socket."""
-        
-        return self.sock.fileno()
+        """Return fd of socket, or None unless connecting or connected,
+        when there's nothing to watch."""
+
+        if self.status in (CONNECTING, CONNECTED):
+            return self.sock.fileno()
+        return None
+
+    def set_reactor(self, reactor):
+        """Called by selector.Reactor when this is added to it.
+        Starts connecting, if register was called."""
+
+        self.reactor = reactor
+        if self.wanted and self.status == IDLE:
+            self.connect()
+
+    def set_resolver(self, resolver):
+        """Resolve names with resolver (See resolver.Resolver)."""
+
+        self.resolver = resolver
+
+    def set_backoff(self, backoff):
+        """Wait between reconnects as told by backoff (A Backoff)."""
+
+        self.backoff = backoff
 
     def do_io(self):
-        """Deal with input on socket."""
+        """Deal with input on socket. Reads whatever is available
+        with a single recv_into, and hands every complete line
+        to handle_lines at once."""
+
+        self.make_room(1)
+        try:
+            read = self.sock.recv_into(self.view[self.buflen:])
+        except socket.error, err:
+            if err.args[0] in WOULDBLOCK:
+                return
+            raise
+        if not read:
+            raise socket.error(errno.ECONNRESET, 'Connection closed by peer')
+        self.received += read
+        self.rxbytes.inc(read)
+        lines = self.split_lines(read)
+        if lines:
+            self.rxlines.inc(len(lines))
+            self.handle_lines(lines)
+
+    def feed(self, data):
+        """Deal with data that was read by someone else, like
+        an asyncio transport (See aio.LineProtocol)."""
+
+        self.make_room(len(data))
+        self.buf[self.buflen:self.buflen + len(data)] = data
+        self.received += len(data)
+        self.rxbytes.inc(len(data))
+        lines = self.split_lines(len(data))
+        if lines:
+            self.rxlines.inc(len(lines))
+            self.handle_lines(lines)
+
+    def make_room(self, needed):
+        """Grow the buffer, if needed, so it has room for needed
+        more bytes. Only happens for lines longer than the buffer."""
 
-        if self.buf is None:
-            self.buf = self.sock.makefile('rb')
-        self.handle_line(self.buf.readline().rstrip())
+        size = len(self.buf)
+        if size - self.buflen >= needed:
+            return
+        while size - self.buflen < needed:
+            size *= 2
+        buf = bytearray(size)
+        buf[:self.buflen] = self.view[:self.buflen]
+        self.buf, self.view = buf, memoryview(buf)
+
+    def split_lines(self, read):
+        """Account for read new bytes at the end of the buffer and
+        return the complete lines now in it, without terminators.
+        Lines end at the last character of the terminator (So a bare
+        LF ends a line too), the rest of it is stripped if it's there.
+        The partial tail (if any) is moved to the start of the buffer,
+        unless it's over MAXLINE, in which case the line is dropped."""
+
+        buf = self.buf
+        last, rest = self.term[-1], self.term[:-1]
+        end = self.buflen + read
+        search = self.buflen
+        start = 0
+        lines = []
+        while True:
+            pos = buf.find(last, search, end)
+            if pos < 0:
+                break
+            stop = pos
+            if rest and pos - len(rest) >= start and buf.startswith(rest, pos - len(rest)):
+                stop -= len(rest)
+            if self.overlong:
+                # The end of the line that was dropped.
+                self.overlong = False
+            else:
+                lines.append(str(buf[start:stop]))
+            start = search = pos + 1
+        if end - start > MAXLINE:
+            self.overlong = True
+            start = end
+        if len(buf) > 4 * MAXLINE:
+            # Don't hold on to the room a big read (See feed) needed.
+            self.buf = bytearray(max(BUFSIZE, 2 * (end - start)))
+            self.view = memoryview(self.buf)
+        if start or self.buf is not buf:
+            self.buf[:end - start] = buf[start:end]
+        self.buflen = end - start
+        return lines
+
+    def reset_buffer(self):
+        """Throw away any partial line, as when reconnecting."""
+
+        self.buflen = 0
+        self.overlong = False
 
     def register(self):
-        """Register this client."""
-        
-        self.sock.connect((self.dst, self.port))
-        self.buf = self.sock.makefile('rb')
-        
+        """Register this client: start connecting, in the background,
+        on the reactor this is added to (Now, or when it's added)."""
+
+        self.wanted = True
+        if self.reactor is not None and self.status == IDLE:
+            self.connect()
+
+    def connect(self):
+        """Resolve the destination, then connect to it."""
+
+        if self.reactor is None or self not in self.reactor.clients:
+            # Removed while waiting to reconnect.
+            self.status = IDLE
+            return
+        self.status = RESOLVING
+        # Stop watching the socket of the last connection, if any.
+        self.reactor.reregister(self)
+        self.resolver.resolve(self.dst, self.port, self.reactor, self.resolved)
+
+    def resolved(self, addresses, error):
+        """The resolver is done with the destination."""
+
+        if self.status != RESOLVING:
+            return
+        if error is not None or not addresses:
+            self.connect_failed(error or 'No addresses for %s' % self.dst)
+            return
+        self.addresses = list(addresses)
+        self.try_address()
+
+    def make_socket(self, family):
+        """A new socket of family, unless sockmaker makes them."""
+
+        if self.sockmaker is socket.socket:
+            return socket.socket(family, socket.SOCK_STREAM)
+        return self.sockmaker()
+
+    def try_address(self):
+        """Start a non-blocking connect to the next address. The
+        reactor tells do_write when it's done (See finish_connect)."""
+
+        if self.status == IDLE or self.reactor is None or self not in self.reactor.clients:
+            self.status = IDLE
+            return
+        family, sockaddr = self.addresses.pop(0)
+        self.sock = self.make_socket(family)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(sockaddr)
+        if err and err not in INPROGRESS:
+            self.sock.close()
+            self.status = WAITING
+            self.connect_failed(socket.error(err, os.strerror(err)))
+            return
+        self.status = CONNECTING
+        self.timer = self.reactor.call_later(self.connect_timeout, self.timed_out)
+        self.reactor.reregister(self)
+
+    def timed_out(self):
+        """The connect took too long."""
+
+        self.timer = None
+        if self.status == CONNECTING:
+            self.status = WAITING
+            self.reactor.reregister(self)
+            self.connect_failed(socket.error(errno.ETIMEDOUT, 'Connect timed out'))
+
+    def finish_connect(self):
+        """The socket became writable while connecting, so the connect
+        is done. Raises socket.error if it failed."""
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise socket.error(err, os.strerror(err))
+        self.status = CONNECTED
+        self.addresses = []
+        self.since = time.time()
+        self.connected()
+
+    def connect_failed(self, error):
+        """Connecting failed with error. Try again."""
+
+        self.reconnect()
+
+    def reconnect(self):
+        """Close the socket, and connect again: to the next address of
+        the destination right away, if there are more, otherwise after
+        a delay from the backoff. Call this from retry."""
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.status == CONNECTED and time.time() - self.since >= self.stable:
+            self.backoff.reset()
+        self.status = WAITING
+        try:
+            self.sock.close()
+        except (socket.error, AttributeError):
+            pass
+        if self.reactor is None:
+            return
+        if self.addresses:
+            self.reactor.call_soon(self.try_address)
+        else:
+            self.timer = self.reactor.call_later(self.backoff.next(), self.connect)
+
+    def hangup(self):
+        """Drop the connection, and connect again (See reconnect)."""
+
+        self.status = WAITING
+        if self.reactor is not None:
+            self.reactor.reregister(self)
+        self.reconnect()
+
+    def close(self):
+        """Drop the connection for good, unlike hangup: the client
+        won't connect again until register is called."""
+
+        self.wanted = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.status = IDLE
+        if self.reactor is not None and self in self.reactor.clients:
+            self.reactor.reregister(self)
+        try:
+            self.sock.close()
+        except (socket.error, AttributeError):
+            pass
+
+    def wants_write(self):
+        """True while connecting, to hear when the connect is done."""
+
+        return self.status == CONNECTING
+
+    def do_write(self):
+        """The socket is writable, so the connect is done."""
+
+        if self.status == CONNECTING:
+            self.finish_connect()
+            self.reactor.want_write(self, self.wants_write())
+
+    def connected(self):
+        """Called once the socket is connected. Extend this
+        to greet the server."""
+
+        self.reset_buffer()
+
+    def handle_lines(self, lines):
+        """Handle all the lines that arrived in one read. Override
+        this to deal with bursts in bulk, by default it calls
+        handle_line on each."""
+
+        for line in lines:
+            self.handle_line(line)
+
     def handle_line(self, line):
         """Override."""
         
@@ -67,24 +395,15 @@ class LineReciever(object):
         
         self.term = new
         
-def makelogger(name, format='%Y %m %d %H:%M'):
+def makelogger(name, format='%Y %m %d %H:%M', **options):
     """Make a logger, logging to name (filepath),
     using format for timestamps.
 
     For more information on format, see man strptime and
-    man strftime."""
+    man strftime. The logger writes from a background thread,
+    see logs.Logger for the options (level, rotation and so on)."""
     
-    logfile = open(name, 'a')
-
-    def log(event):
-        """Log this event."""
-        
-        now = datetime.datetime.now().strftime(format)
-        if isinstance(event, unicode):
-            event = event.encode('utf-8')
-        for line in str(event).split('\n'):
-            logfile.write("%s | %s\n" % (now, line))
-    return log
+    return Logger(name, format, **options)
 
 def nonlogger(name):
     """Fake a logger."""
@@ -97,12 +416,16 @@ class LoggingReciever(LineReciever):
     logs exceptions."""
     
     def __init__(self, destination, port, sockmaker=socket.socket, log=None):
-        """Log is a callable of one argument."""
+        """Log is a callable of one argument. If it has wire and error
+        methods (Like a logs.Logger), raw lines are logged with wire
+        and errors with error, so they can be filtered by level."""
         
         if log is not None:
             self.log = log
         else:
             self.log = makelogger(destination)
+        self.logwire = getattr(self.log, 'wire', self.log)
+        self.logerror = getattr(self.log, 'error', self.log)
         LineReciever.__init__(self, destination, port, sockmaker)
         
     def do_io(self):
@@ -111,35 +434,149 @@ class LoggingReciever(LineReciever):
         try:
             LineReciever.do_io(self)
         except Exception, error:
-            self.log(error)
+            self.logerror(error)
             raise
 
+    def connect_failed(self, error):
+        """Log why connecting failed, and try again."""
+
+        self.logerror('Failed to connect to %s: %s' % (self.name, error))
+        LineReciever.connect_failed(self, error)
+
 class BufferedSockWriter(LoggingReciever):
     """This behaves like LoggingReciever aside from
     using adding a wline method for writing to
-    its socket (with sendall), and using buffering to
+    its socket, and using buffering to
     stay nice to the server it is connected to.
 
-    You can use set_interval to set a new interval between
-    writes. Should be a relatively small number."""
+    Lines are queued by wline, and written by do_write when
+    the selector.Reactor this is added to finds the socket writable,
+    so a slow server never blocks the reactor. Output is only
+    written on a connection, and what's still queued when it's
+    made or lost is thrown away (And logged), as it was meant for
+    another connection or comes before registering.
+
+    How fast lines are written is decided by a flood.FloodControl,
+    which you can replace with set_flood. set_interval is a shortcut
+    for writing one line every interval seconds, without bursts."""
     
     def __init__(self, destination, port, sockmaker=socket.socket, log=None):
         """See LoggingReciever.__init__."""
         
         LoggingReciever.__init__(self, destination, port, sockmaker, log)
-        self.last = 0
-        self.interval = 1
+        self.reactor = None
+        self.flood = FloodControl()
+        self.urgent = collections.deque()
+        self.pending = ''
+        self.throttled = False
+        self.unthrottler = None
+        self.txbytes = metrics.registry.counter(
+            'connection_sent_bytes_total', 'Bytes sent.', conn=self.name)
+        self.queued = metrics.registry.gauge(
+            'connection_queued_lines', 'Lines waiting for flood control.', conn=self.name)
 
     def set_interval(self, new):
-        """Set a new interval for buffered output."""
-        
-        self.interval = new
+        """Set a new interval for buffered output. An interval of
+        0 (Or less) turns flood control off."""
         
+        if new <= 0:
+            self.set_flood(FloodControl(rate=None))
+        else:
+            self.set_flood(FloodControl(burst=1, rate=1.0 / new))
+
+    def set_flood(self, flood):
+        """Use flood (a flood.FloodControl) to schedule output.
+        Lines already queued are kept."""
+
+        for line in self.flood.drain():
+            flood.push(line)
+        self.flood = flood
+        self.update_interest()
+
+    def reset_buffer(self):
+        """Throw away partial input and any queued output."""
+
+        LoggingReciever.reset_buffer(self)
+        dropped = len(self.flood) + len(self.urgent) + bool(self.pending)
+        if dropped:
+            self.log('Dropping %d queued lines for %s' % (dropped, self.name))
+        self.flood.clear()
+        self.urgent.clear()
+        self.pending = ''
+        if self.unthrottler is not None:
+            self.unthrottler.cancel()
+            self.unthrottler = None
+        self.throttled = False
+
+    def close(self):
+        """See LineReciever.close. Queued output is thrown away."""
+
+        self.reset_buffer()
+        LoggingReciever.close(self)
+
     def wline(self, line):
-        """Write a line to socket."""
-        
-        self.log('>>> %s' % line)
-        if time.time() < self.last + self.interval:
-            time.sleep(self.interval)
-        self.sock.sendall(line.rstrip() + self.term)
+        """Queue a line for writing to socket."""
         
+        self.logwire('>>> ' + line)
+        self.flood.push(line.rstrip() + self.term)
+        self.queued.set(len(self.flood))
+        self.update_interest()
+
+    def wline_urgent(self, line):
+        """Queue a line that is written before anything else and
+        isn't subject to flood control or logged, like a PONG."""
+
+        self.urgent.append(line + self.term)
+        self.update_interest()
+
+    def wants_write(self):
+        """True if there's output that may be written now,
+        or a connect in progress."""
+
+        return (self.status == CONNECTING or bool(self.pending) or bool(self.urgent) or
+                bool(self.flood) and not self.throttled)
+
+    def update_interest(self):
+        """Tell the reactor whether we want to write, and
+        schedule a wakeup if the next line must wait for flood control."""
+
+        if self.reactor is None:
+            return
+        if not self.pending and self.flood and not self.throttled:
+            wait = self.flood.delay()
+            if wait > 0:
+                self.throttled = True
+                self.unthrottler = self.reactor.call_later(wait, self.unthrottle)
+        self.reactor.want_write(self, self.wants_write())
+
+    def unthrottle(self):
+        """Enough time has passed for the next line to be written."""
+
+        self.throttled = False
+        self.unthrottler = None
+        self.update_interest()
+
+    def do_write(self):
+        """The socket is writable, so write as much as flood
+        control allows, in a single send."""
+
+        if self.status == CONNECTING:
+            # Greeting the server queues output, so carry on.
+            self.finish_connect()
+        if not self.pending:
+            lines = list(self.urgent)
+            self.urgent.clear()
+            if not self.throttled:
+                lines.extend(self.flood.ready())
+            self.pending = ''.join(lines)
+        if self.pending:
+            try:
+                sent = self.sock.send(self.pending)
+            except socket.error, err:
+                if err.args[0] not in WOULDBLOCK:
+                    raise
+                sent = 0
+            self.pending = self.pending[sent:]
+            self.txbytes.inc(sent)
+            self.queued.set(len(self.flood))
+        self.update_interest()
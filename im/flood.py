@@ -0,0 +1,258 @@
+"""
+This module provides flood control for outbound lines, modeled
+on the penalty counters IRC servers use to decide when a client
+is flooding. A client may send a burst of lines, after which the
+budget refills at a steady rate; expensive commands and commands
+with many targets use up more of the budget.
+
+Use it through connection.BufferedSockWriter.set_flood.
+"""
+
+import time
+import collections
+
+# How much of the budget each command uses, relative to a PRIVMSG.
+WEIGHTS = {
+    'PRIVMSG': 1,
+    'NOTICE': 1,
+    'PONG': 0,
+    'JOIN': 2,
+    'PART': 1,
+    'MODE': 1,
+    'WHO': 3,
+    'WHOIS': 2,
+    'WHOWAS': 2,
+    'NAMES': 2,
+    'LIST': 5,
+    }
+
+# Commands that cost once per target when given a comma separated list.
+MULTITARGET = ('PRIVMSG', 'NOTICE', 'JOIN', 'PART', 'WHOIS')
+
+# Commands whose first parameter is the target used for fairness.
+TARGETED = ('PRIVMSG', 'NOTICE', 'JOIN', 'PART', 'KICK',
+            'MODE', 'TOPIC', 'INVITE')
+
+class TokenBucket(object):
+    """A budget of tokens, refilled at a steady rate up
+    to a maximum burst."""
+
+    def __init__(self, burst, rate, now=None):
+        """burst is the most tokens that can be saved up,
+        rate is how many tokens are added each second (None for
+        no limit)."""
+
+        self.burst = float(burst)
+        self.rate = None if rate is None else float(rate)
+        self.tokens = self.burst
+        if now is None:
+            now = time.time()
+        self.stamp = now
+
+    def refill(self, now):
+        """Add the tokens earned since the last refill."""
+
+        if self.rate is None:
+            self.tokens = self.burst
+        elif now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def full(self, now):
+        """True if no tokens have been used."""
+
+        self.refill(now)
+        return self.tokens >= self.burst
+
+    def delay(self, cost, now):
+        """Seconds until cost tokens are available."""
+
+        self.refill(now)
+        # Never demand more than a full bucket, or a line costing
+        # more than the burst would never go out.
+        missing = min(cost, self.burst) - self.tokens
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate
+
+    def consume(self, cost, now):
+        """Use cost tokens if they are available, return a true
+        value if they were."""
+
+        if self.delay(cost, now) > 0:
+            return False
+        self.tokens -= cost
+        return True
+
+class FloodControl(object):
+    """Decides when queued lines may be written.
+
+    All lines draw from one global TokenBucket. When fair is set, lines
+    are queued per target (the channel or nick of a PRIVMSG, JOIN and so
+    on) and the targets take turns, so one long reply can't starve
+    everyone else. When target_burst and target_rate are set, every
+    target also has its own, smaller, budget.
+    """
+
+    def __init__(self, burst=10, rate=1, weights=None, length_unit=None,
+                 fair=False, target_burst=None, target_rate=None):
+        """burst and rate configure the global TokenBucket, a rate
+        of None lets every line through at once.
+        weights maps commands to costs, and is merged with WEIGHTS.
+        If length_unit is set, a line also costs one extra token per
+        length_unit bytes, like the penalty of ircd2 and ircu."""
+
+        self.bucket = TokenBucket(burst, rate)
+        self.weights = dict(WEIGHTS)
+        if weights:
+            self.weights.update(weights)
+        self.length_unit = length_unit
+        self.fair = fair
+        self.target_burst = target_burst
+        self.target_rate = target_rate
+        self.buckets = {}
+        self.queues = {}
+        self.order = collections.deque()
+        self.size = 0
+
+    def __len__(self):
+        """Number of queued lines."""
+
+        return self.size
+
+    def cost(self, line):
+        """The cost of writing line."""
+
+        parts = line.split(' ', 2)
+        command = parts[0].upper()
+        cost = self.weights.get(command, 1)
+        if command in MULTITARGET and len(parts) > 1:
+            cost *= parts[1].count(',') + 1
+        if self.length_unit:
+            cost += len(line) / float(self.length_unit)
+        return cost
+
+    def target(self, line):
+        """The target used to queue line fairly, or None."""
+
+        parts = line.split(' ', 2)
+        if len(parts) > 1 and parts[0].upper() in TARGETED:
+            return parts[1].lower()
+        return None
+
+    def push(self, line):
+        """Queue line."""
+
+        if self.fair:
+            target = self.target(line)
+        else:
+            target = None
+        queue = self.queues.get(target)
+        if queue is None:
+            queue = self.queues[target] = collections.deque()
+            self.order.append(target)
+        queue.append((self.cost(line), line))
+        self.size += 1
+
+    def drain(self):
+        """Remove and return all queued lines, ignoring the budget."""
+
+        lines = []
+        while self.order:
+            target = self.order.popleft()
+            lines.extend(line for cost, line in self.queues.pop(target))
+        self.size = 0
+        return lines
+
+    def clear(self):
+        """Forget all queued lines."""
+
+        self.queues.clear()
+        self.order.clear()
+        self.size = 0
+
+    def _bucket(self, target, now):
+        """The bucket of target, if targets have buckets."""
+
+        if self.target_rate is None or target is None:
+            return None
+        bucket = self.buckets.get(target)
+        if bucket is None:
+            bucket = self.buckets[target] = TokenBucket(self.target_burst,
+                                                        self.target_rate, now)
+        return bucket
+
+    def pop(self, now=None):
+        """Return the next line that may be written now, or None."""
+
+        if now is None:
+            now = time.time()
+        for _ in xrange(len(self.order)):
+            target = self.order[0]
+            queue = self.queues[target]
+            cost, line = queue[0]
+            bucket = self._bucket(target, now)
+            if bucket is not None and bucket.delay(cost, now) > 0:
+                # This target has used its share, give the next one a go.
+                self.order.rotate(-1)
+                continue
+            if not self.bucket.consume(cost, now):
+                return None
+            if bucket is not None:
+                bucket.consume(cost, now)
+            queue.popleft()
+            self.size -= 1
+            self.order.popleft()
+            if queue:
+                self.order.append(target)
+            else:
+                del self.queues[target]
+            return line
+        return None
+
+    def ready(self, now=None):
+        """Return every line that may be written now."""
+
+        if now is None:
+            now = time.time()
+        lines = []
+        line = self.pop(now)
+        while line is not None:
+            lines.append(line)
+            line = self.pop(now)
+        self.expire(now)
+        return lines
+
+    def delay(self, now=None):
+        """Seconds until the next line may be written, or None
+        if nothing is queued."""
+
+        if not self.size:
+            return None
+        if now is None:
+            now = time.time()
+        # Mirrors pop: targets over their own budget are skipped, the
+        # first one that isn't has to wait for the global budget.
+        best = None
+        for target in self.order:
+            cost = self.queues[target][0][0]
+            wait = self.bucket.delay(cost, now)
+            bucket = self._bucket(target, now)
+            blocked = bucket is not None and bucket.delay(cost, now) > 0
+            if blocked:
+                wait = max(wait, bucket.delay(cost, now))
+            if best is None or wait < best:
+                best = wait
+            if not blocked:
+                break
+        return best
+
+    def expire(self, now):
+        """Forget the buckets of idle targets that have refilled, to
+        keep memory bounded with many targets."""
+
+        if len(self.buckets) <= len(self.queues) + 64:
+            return
+        for target in self.buckets.keys():
+            if target not in self.queues and self.buckets[target].full(now):
+                del self.buckets[target]
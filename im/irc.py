@@ -3,9 +3,99 @@ This module provides a reasonably
 complete IRC client for use with selector.Reactor.
 """
 
-from connection import BufferedSockWriter
+from connection import BufferedSockWriter, CONNECTED
+from router import Router
+from tracker import Tracker
+from casemap import Casemap
+from isupport import ISupport
 import socket
+import time
+import calendar
+import itertools
 import irc2num
+import metrics
+
+# Where an IRCProtocol is in registering with the server.
+OFFLINE = 'offline'
+NEGOTIATING = 'negotiating'
+REGISTERING = 'registering'
+READY = 'ready'
+# Replies to NICK that mean another one must be tried.
+NICK_TAKEN = ('ERR_NICKNAMEINUSE', 'ERR_ERRONEUSNICKNAME', 'ERR_UNAVAILRESOURCE')
+# Last characters tried in turn on a nick as long as the server allows.
+NICK_ENDINGS = '_0123456789'
+# IRCv3 capabilities asked for, if the server has them.
+CAPABILITIES = ('batch', 'message-tags', 'echo-message', 'multi-prefix',
+                'server-time', 'extended-join', 'userhost-in-names')
+
+# The longest user@host (A ~, a 9 character user and a 63 character
+# host) a server could show ours as, before we know.
+USERHOST_GUESS = 1 + 10 + 1 + 63
+
+TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+def unescape_tag(value):
+    """Undo the escaping of an IRCv3 tag value."""
+
+    if '\\' not in value:
+        return value
+    chars = []
+    escaped = False
+    for char in value:
+        if escaped:
+            chars.append(TAG_ESCAPES.get(char, char))
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        else:
+            chars.append(char)
+    return ''.join(chars)
+
+def parse_time(stamp):
+    """Seconds since the epoch of an IRCv3 server-time,
+    like 2011-10-19T16:40:51.620Z."""
+
+    whole, _, fraction = stamp.rstrip('Z').partition('.')
+    seconds = calendar.timegm(time.strptime(whole, '%Y-%m-%dT%H:%M:%S'))
+    if fraction.isdigit():
+        seconds += float('0.' + fraction)
+    return seconds
+
+def split_text(text, room):
+    """Split text (An utf-8 str) into lines of at most room bytes.
+    Lines break at newlines, and at the last space that fits, unless a
+    word is longer than a line, which is broken between characters.
+    Empty lines are left out, as they can't be sent."""
+
+    room = max(room, 4)
+    lines = []
+    for text in text.replace('\r', '').split('\n'):
+        while len(text) > room:
+            cut = text.rfind(' ', 0, room + 1)
+            if cut > 0:
+                lines.append(text[:cut])
+                text = text[cut + 1:]
+                continue
+            cut = room
+            # Don't cut in the middle of a character: back up to its first byte.
+            while cut > room - 4 and '\x80' <= text[cut] < '\xc0':
+                cut -= 1
+            lines.append(text[:cut])
+            text = text[cut:]
+        if text:
+            lines.append(text)
+    return lines
+
+def handler_name(handler):
+    """A name for handler, for metrics and reports: its name attribute,
+    or the name of its run function, or the name of its class."""
+
+    name = getattr(handler, 'name', None)
+    if name is None:
+        name = getattr(handler.run, '__name__', 'run')
+        if name == 'run':
+            name = handler.__class__.__name__
+    return name
 
 class ParseError(Exception):
     """Represents an IRC parse error."""
@@ -15,28 +105,95 @@ class ParseError(Exception):
     
 class ParsedLine(object):
     """Instanciate this with an ircline to be able to query it
-    for generic information."""
-    
-    def __init__(self, ircline):
-        """Provide a unicode or str object to parse."""
+    for generic information.
+
+    The line is tokenized once, when instanciated, into:
+    rawtags - the IRCv3 tags without the leading @, or None.
+    prefix - the prefix without the leading :, or ''.
+    nickname, user, host - the parts of the prefix.
+    verb - the command as it appeared on the line.
+    rawparams - everything after the command.
+    args - a list of the parameters, with the trailing one last.
+    cmdargs - set by IRCProtocol to the arguments of the bot command
+              (See router.Router) that made the running handler run.
+    batch - set by IRCProtocol on the BATCH line ending a batch (See
+            Batch), which handlers get instead of the lines in it.
+    arrived - when the line arrived, if known.
+    The methods below just return these, or things derived from them.
+    """
+
+    __slots__ = ('ircline', 'rawtags', 'tagdict', 'prefix', 'nickname',
+                 'user', 'host', 'verb', 'rawparams', 'args', 'cmdargs',
+                 'batch', 'arrived')
+
+    def __init__(self, ircline, arrived=None):
+        """Provide a unicode or str object to parse, and
+        optionally the time it arrived."""
         
-        self.ircline = ircline.strip()
+        line = self.ircline = ircline.strip()
+        self.rawtags = self.tagdict = self.cmdargs = self.batch = None
+        self.arrived = arrived
+        if line.startswith('@'):
+            self.rawtags, _, line = line[1:].partition(' ')
+            line = line.lstrip(' ')
+        if line.startswith(':'):
+            self.prefix, _, line = line[1:].partition(' ')
+            line = line.lstrip(' ')
+        else:
+            self.prefix = ''
+        self.nickname, bang, rest = self.prefix.partition('!')
+        if bang:
+            self.user, _, self.host = rest.partition('@')
+        else:
+            self.nickname, _, self.host = self.nickname.partition('@')
+            self.user = ''
+        self.verb, _, rest = line.partition(' ')
+        self.rawparams = rest.lstrip(' ')
+        middle, colon, trailing = (' ' + self.rawparams).partition(' :')
+        self.args = middle.split()
+        if colon:
+            self.args.append(trailing)
+
+    def tags(self):
+        """The IRCv3 message tags as a dict, with escapes undone.
+        Tags without a value map to ''."""
+
+        if self.tagdict is None:
+            self.tagdict = {}
+            if self.rawtags:
+                for tag in self.rawtags.split(';'):
+                    key, _, value = tag.partition('=')
+                    if key:
+                        self.tagdict[key] = unescape_tag(value)
+        return self.tagdict
+
+    def time(self):
+        """When the server says it sent the line (IRCv3 server-time),
+        or else when it arrived, in seconds since the epoch."""
+
+        if self.rawtags:
+            stamp = self.tags().get('time')
+            if stamp:
+                try:
+                    return parse_time(stamp)
+                except ValueError:
+                    pass
+        return self.arrived
 
     def hostmask(self):
         """The hostmask of the sender (Potentially a server)."""
         
-        return self.ircline.split()[0][1:]
+        return self.prefix
 
     def nick(self):
         """Nick of the sender."""
         
-        return self.hostmask().split('!')[0].replace('~', '')
+        return self.nickname
 
     def command(self):
         """Which command was used?"""
 
-        com = self.ircline.split()[1]
-        return irc2num.num2rpl.get(com, com)
+        return irc2num.num2rpl.get(self.verb, self.verb)
 
     def __str__(self):
         """Printable string of line."""
@@ -46,19 +203,21 @@ class ParsedLine(object):
     def params(self):
         """Get the params part of the line."""
 
-        return ' '.join(self.ircline.split(' ')[2:])
+        return self.rawparams
 
     def message(self):
         """Get the message part of a privmsg or notice or equivalent line."""
 
-        return ' '.join(self.params().split()[1:])[1:]
+        if len(self.args) > 1:
+            return self.args[-1]
+        return ''
 
     def target(self):
         """Get the target of a command."""
 
         if self.command() in ('PRIVMSG', 'NOTICE', 'TOPIC',
-                              'JOIN', 'PART', 'KICK'):
-            return self.params().split()[0]
+                              'JOIN', 'PART', 'KICK') and self.args:
+            return self.args[0]
         else:
             raise ParseError('Getting target of command %s not yet supported.' % self.command())
 
@@ -77,6 +236,24 @@ class ParsedLine(object):
         info['hostmask'] = self.hostmask()
         return info
     
+class Batch(object):
+    """Lines the server grouped with BATCH (IRCv3 batch), like
+    the QUITs of a netsplit or the messages of chathistory."""
+
+    __slots__ = ('ref', 'type', 'params', 'lines', 'parent')
+
+    def __init__(self, ref, type, params, parent=None):
+        self.ref = ref
+        self.type = type
+        self.params = params
+        # ParsedLines, including the BATCH lines ending batches in this one.
+        self.lines = []
+        # The batch this one is in, if any.
+        self.parent = parent
+
+    def __repr__(self):
+        return '<Batch %s %s (%d lines)>' % (self.ref, self.type, len(self.lines))
+
 class IRCProtocol(BufferedSockWriter):
     """Extend BufferedSockWriter to give a logging, buffered client
     supporting a decent subset of the irc protocol.
@@ -97,84 +274,557 @@ class IRCProtocol(BufferedSockWriter):
                                     wants to run on this line.
     run(ParsedLine, state, IRCProtocol) - Let handler perform IO with
                                           IRCProtocol instance.
-    This is the plugin system of this class.
+    This is the plugin system of this class. Slow handlers can be run
+    on a pool of workers, see set_workers.
+
+    A handler may also have these attributes, so it is only
+    considered for the lines it can care about:
+    commands - the commands (As returned by ParsedLine.command,
+               or numerics) the handler wants to see.
+    triggers, prefixes, patterns - bot commands, like '!remind',
+               the message must match. See router.Router. Implies
+               ('PRIVMSG', 'NOTICE') if commands is missing.
+    Lines are dispatched on commands with a dict lookup, and on
+    triggers with one router.Router per command. interested is then
+    only called for the handlers found (It may be left out, if the
+    attributes say it all), and the arguments of the bot command
+    are in ParsedLine.cmdargs while it runs. Handlers without
+    any of the attributes are called for every line. Messages of our
+    own that the server echoes back (IRCv3 echo-message) only go to
+    handlers with a true echoes attribute.
+
+    Registration is driven by the lines from the server, so any number
+    of clients register at once on one reactor: once connected, the
+    client asks for the capabilities of the server (CAP LS), sends
+    NICK and USER, asks for the ones in set_capabilities (CAP REQ),
+    ends the negotiation (CAP END), waits for RPL_WELCOME and
+    joins the channels given to set_autojoin. While registering,
+    ERR_NICKNAMEINUSE (And the like) is answered with the next
+    state.nick() (Or a variation of the last nick, see vary_nick),
+    until self.nick_tries were refused and it hangs up. self.phase tells how far it got (OFFLINE,
+    NEGOTIATING, REGISTERING, READY), and self.caps which
+    capabilities the server gave us.
+
+    With the batch capability, lines the server groups in a batch
+    aren't dispatched one by one: the tracker sees each, but handlers
+    get the BATCH line ending the batch, with the lines in line.batch
+    (A Batch), so they can deal with a netsplit in one go.
+
+    self.tracker (A tracker.Tracker) knows the channels the client is
+    in and who is in them. It's updated before handlers see a line.
+    self.casemap (A casemap.Casemap) compares nicks and channels
+    the way the server does, and handlers should use it to key
+    dicts by nick.
+
+    self.isupport (An isupport.ISupport) holds the limits the server
+    gave in RPL_ISUPPORT. They're used to merge PRIVMSG and NOTICE
+    to several targets, JOIN and PART of several channels, and modes
+    set on members of the same channel (Like op and deop) into as few
+    lines as the server allows, see queue.
     """
     
+    def __init__(self, destination, port, sockmaker=socket.socket, log=None):
+        """See BufferedSockWriter.__init__."""
+
+        BufferedSockWriter.__init__(self, destination, port, sockmaker, log)
+        self.workers = None
+        self.wirelog = None
+        self.pings = {}
+        self.lag = None
+        self.timed = metrics.registry.enabled
+        self.handlertimes = {}
+        self.profiler = None
+        self.lagged = metrics.registry.gauge(
+            'irc_lag_seconds', 'Round trip time of the last ping.', conn=self.name)
+        self.phase = OFFLINE
+        self.nickname = None
+        # Keys (See casemap) of the nicks tried while registering,
+        # and how many to try before hanging up.
+        self.tried = set()
+        self.nick_tries = 10
+        # nick!user@host, as others see us, once we know.
+        self.hostmask = None
+        self.casemap = Casemap()
+        self.tracker = Tracker(self.casemap)
+        self.autojoin = []
+        self.registration = None
+        self.registration_timeout = 120
+        self.registertime = metrics.registry.histogram(
+            'irc_registration_seconds', 'Time from connected to RPL_WELCOME.', conn=self.name)
+        self.isupport = ISupport()
+        self.outbox = []
+        self.capabilities = CAPABILITIES
+        self.offered = set()
+        self.caps = set()
+        self.requests = 0
+        self.batches = {}
+        self.arrived = None
+
     def privmsg(self, target, message):
-        """Send message to target. Message is either a list
-        of unicode/str instances, or a unicode/str instance."""
+        """Send message to target (Or a list of targets). Message is
+        either a list of unicode/str instances, or a unicode/str instance.
+        Long messages are split over as few lines as they fit on,
+        see split_text and room."""
         
-        if isinstance(message, list):
-            for line in message:
-                self.privmsg(target, line)
-        elif isinstance(message, unicode):
-            message = message.encode('utf-8')
-        while message:
-            line, message = message[:400], message[400:]
-            self.wline('PRIVMSG %s :%s' % (target, line))
+        self.say('PRIVMSG', target, message)
 
     def notice(self, target, message):
         """Send a notice. See privmsg for description of params."""
         
-        if isinstance(message, list):
-            for line in message:
-                self.notice(target, message)
-        elif isinstance(message, unicode):
-            message = message.encode('utf-8')
-        while message:
-            line, message = message[:400], message[400:]
-            self.wline('NOTICE %s :%s' % (target, line))
-    
+        self.say('NOTICE', target, message)
+
+    def say(self, command, target, message):
+        """Send message with command (PRIVMSG or NOTICE), see privmsg."""
+
+        if not isinstance(target, (list, tuple)):
+            target = [target]
+        elif not target:
+            return
+        if not isinstance(message, list):
+            message = [message]
+        room = self.room(command, max(target, key=len))
+        for text in message:
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            for line in split_text(text, room):
+                self.queue(command, line, *target)
+
+    def room(self, command, target):
+        """How many bytes of text fit on a line with command to target,
+        as the server passes it on: prefixed with our hostmask, and at
+        most LINELEN long (See isupport)."""
+
+        if self.hostmask is not None:
+            mask = len(self.hostmask)
+        else:
+            mask = len(self.nickname or '') + USERHOST_GUESS
+        # :mask command target :text
+        used = 1 + mask + 1 + len(command) + 1 + len(target) + 2 + len(self.term)
+        return self.isupport.linelen - used
+
     def set_handlers(self, handlers):
         """Set the line handlers on self to the list
         handlers."""
         
         self.handlers = handlers
+        self.index_handlers()
+
+    def set_workers(self, workers):
+        """Run handlers with a true offload attribute on workers,
+        a workers.WorkerPool, instead of in the reactor thread."""
+
+        self.workers = workers
+
+    def set_profiler(self, profiler):
+        """Time handlers with profiler, a profiling.HandlerProfiler.
+        None turns profiling off."""
+
+        self.profiler = profiler
+
+    def set_wirelog(self, wirelog):
+        """Record every line sent and received (Except PING and PONG)
+        in wirelog, a wirelog.WireLog."""
+
+        self.wirelog = wirelog
+
+    def wline(self, line):
+        """Queue a line for writing to socket, recording it in
+        the wirelog if there is one. Lines from queue go first."""
+
+        if self.outbox:
+            self.flush_outbox()
+        if self.wirelog is not None:
+            self.wirelog.record(self.name, '>', line)
+        BufferedSockWriter.wline(self, line)
 
     def set_state(self, state):
         """Set the state of self."""
         
         self.state = state
 
-    def add_handler(self):
+    def add_handler(self, handler):
         """Add a handler to self."""
         
         self.handlers.append(handler)
-        
-    def register(self):
-        """Register this irc client.
+        self.index_handlers()
+
+    def index_handlers(self):
+        """Build the dispatch table from the commands and triggers
+        of the handlers. Maps commands to the (order, handler, None)
+        to consider for them, and to a router.Router for the
+        handlers with triggers."""
+
+        self.dispatch = {}
+        self.routers = {}
+        self.catchall = []
+        declared = []
+        for order, handler in enumerate(self.handlers):
+            commands = getattr(handler, 'commands', None)
+            routed = [name for name in ('triggers', 'prefixes', 'patterns')
+                      if getattr(handler, name, None)]
+            if commands is None and not routed:
+                self.catchall.append((order, handler, None))
+                declared.append((order, handler, None, False))
+                continue
+            if commands is None:
+                commands = ('PRIVMSG', 'NOTICE')
+            commands = set(irc2num.num2rpl.get(com, com) for com in commands)
+            declared.append((order, handler, commands, bool(routed)))
+        for order, handler, commands, routed in declared:
+            for command in commands or ():
+                if command not in self.dispatch:
+                    self.dispatch[command] = [
+                        (other, otherhandler, None)
+                        for other, otherhandler, othercommands, otherrouted in declared
+                        if othercommands is None or
+                        command in othercommands and not otherrouted]
+                if routed:
+                    self.routers.setdefault(command, Router()).add(handler, order)
+
+    def dispatch_for(self, line):
+        """The (order, handler, args) to consider for line. args is
+        the list of arguments to a trigger when the handler was found
+        through one, otherwise None."""
+
+        command = line.command()
+        handlers = self.dispatch.get(command, self.catchall)
+        router = self.routers.get(command)
+        if router is not None:
+            matches = router.match(line.message())
+            if matches:
+                return sorted(handlers + matches)
+        return handlers
+
+    def set_casemapping(self, name):
+        """Compare nicks and channels by the casemapping called name
+        (See casemap), as the server advertises in ISUPPORT."""
+
+        if name == self.casemap.name:
+            return
+        self.casemap = Casemap(name)
+        if self.tracker is not None:
+            self.tracker.set_fold(self.casemap)
+
+    def supported(self, line):
+        """Learn what the server supports from an RPL_ISUPPORT line."""
+
+        params = line.args[1:]
+        if params and ' ' in params[-1]:
+            # :are supported by this server
+            params = params[:-1]
+        self.isupport.update(params)
+        self.use_isupport()
+
+    def use_isupport(self):
+        """Compare names and read modes the way self.isupport says."""
+
+        self.set_casemapping(self.isupport.casemapping)
+        if self.tracker is not None:
+            self.tracker.set_prefixes(self.isupport.prefix)
+            self.tracker.set_chanmodes(*self.isupport.chanmodes)
+
+    def set_tracker(self, tracker):
+        """Keep track of channels and users with tracker (A
+        tracker.Tracker), or not at all if it's None."""
+
+        self.tracker = tracker
+
+    def set_capabilities(self, capabilities):
+        """Ask for capabilities (A list of names) when registering,
+        instead of CAPABILITIES."""
+
+        self.capabilities = capabilities
 
-        Sends nick, user and ircname."""
+    def set_autojoin(self, channels):
+        """Join channels (A list) once registered."""
+
+        self.autojoin = channels
+
+    def connected(self):
+        """Register this irc client, now that it's connected.
+
+        Asks for the capabilities of the server, and sends
+        nick, user and ircname. The rest happens in register_step."""
         
-        BufferedSockWriter.register(self)
-        nick, user = self.state.nick(), self.state.user()
-        ircname = self.state.ircname()
-        self.wline('NICK %s' % nick)
+        BufferedSockWriter.connected(self)
+        self.phase = NEGOTIATING
+        self.nickname = self.state.nick()
+        self.tried = set([self.casemap(self.nickname)])
+        user, ircname = self.state.user(), self.state.ircname()
+        self.wline('CAP LS 302')
+        self.wline('NICK %s' % self.nickname)
         self.wline('USER %s 0 * : %s' % (user, ircname))
-        
+        if self.reactor is not None:
+            self.registration = self.reactor.call_later(
+                self.registration_timeout, self.registration_expired)
+
+    def register_step(self, line):
+        """Move registration along, as told by line from the server."""
+
+        command = line.command()
+        if command == 'ERR_UNKNOWNCOMMAND' and line.args[1:2] == ['CAP']:
+            # The server is too old for capabilities.
+            self.phase = REGISTERING
+        elif command in NICK_TAKEN:
+            if len(self.tried) >= self.nick_tries:
+                self.logerror('No nick left to try on %s' % self.name)
+                self.hangup()
+                return
+            nick = self.state.nick()
+            if self.casemap(nick) in self.tried:
+                # The state has no other nick for us, vary the last one.
+                nick = self.vary_nick(self.nickname)
+            self.tried.add(self.casemap(nick))
+            self.nickname = nick
+            self.wline('NICK %s' % nick)
+        elif command == 'RPL_WELCOME':
+            self.welcomed(line)
+
+    def vary_nick(self, nick):
+        """A nick like nick that wasn't tried yet: with a _ added, or,
+        at the NICKLEN of the server, its last character replaced."""
+
+        limit = self.isupport.nicklen
+        if len(nick) < limit:
+            return nick + '_'
+        for char in NICK_ENDINGS:
+            varied = nick[:limit - 1] + char
+            if self.casemap(varied) not in self.tried:
+                return varied
+        return varied
+
+    def cap(self, line):
+        """Negotiate capabilities, as told by a CAP line."""
+
+        if len(line.args) < 3:
+            return
+        subcommand = line.args[1]
+        # Values (Like sasl=PLAIN) don't matter to us.
+        names = [name.partition('=')[0] for name in line.args[-1].split()]
+        if subcommand in ('LS', 'NEW'):
+            self.offered.update(names)
+            # A * before the list means more LS lines are coming.
+            if line.args[2] != '*' and self.phase in (NEGOTIATING, READY):
+                self.request_caps()
+        elif subcommand == 'ACK':
+            for name in names:
+                if name.startswith('-'):
+                    self.caps.discard(name[1:])
+                else:
+                    self.caps.add(name)
+            self.cap_answered()
+        elif subcommand == 'NAK':
+            self.cap_answered()
+        elif subcommand == 'DEL':
+            self.offered.difference_update(names)
+            self.caps.difference_update(names)
+
+    def request_caps(self):
+        """Ask for the capabilities we want that the server offers,
+        or end the negotiation if there are none."""
+
+        wanted = [name for name in self.capabilities
+                  if name in self.offered and name not in self.caps]
+        if wanted:
+            self.requests += 1
+            self.wline('CAP REQ :%s' % ' '.join(wanted))
+        elif self.phase == NEGOTIATING and not self.requests:
+            self.end_negotiation()
+
+    def cap_answered(self):
+        """The server answered a CAP REQ."""
+
+        self.requests = max(self.requests - 1, 0)
+        if self.phase == NEGOTIATING and not self.requests:
+            self.end_negotiation()
+
+    def end_negotiation(self):
+        """Done with capabilities, let registration finish."""
+
+        self.wline('CAP END')
+        self.phase = REGISTERING
+
+    def welcomed(self, line):
+        """The server accepted us: note our nick and join
+        the autojoin channels."""
+
+        if self.phase == NEGOTIATING:
+            # Some servers don't wait for CAP END.
+            self.wline('CAP END')
+        self.phase = READY
+        if line.args:
+            self.nickname = line.args[0]
+        # Welcome to the network, nick!user@host
+        mask = line.message().rpartition(' ')[2]
+        if mask.partition('!')[0] == self.nickname and '@' in mask:
+            self.hostmask = mask
+        if self.registration is not None:
+            self.registration.cancel()
+            self.registration = None
+        self.registertime.observe(time.time() - self.since)
+        for channel in self.autojoin:
+            self.join(channel)
+
+    def learn_hostmask(self, line):
+        """Note our hostmask, from a JOIN of ours, or the host
+        from RPL_HOSTHIDDEN."""
+
+        if not self.nickname:
+            return
+        if line.verb == 'JOIN':
+            if line.user and self.casemap.equal(line.nickname, self.nickname):
+                self.hostmask = line.prefix
+        elif self.hostmask is not None and len(line.args) > 2:
+            self.hostmask = '%s@%s' % (self.hostmask.partition('@')[0], line.args[1])
+
+    def registration_expired(self):
+        """The server took too long to welcome us, try again."""
+
+        self.registration = None
+        if self.phase != READY:
+            self.logerror('Registration with %s timed out' % self.name)
+            self.hangup()
+
+    def handle_lines(self, lines):
+        """See connection.LineReciever.handle_lines. Notes the time the
+        lines arrived once, for ParsedLine.time."""
+
+        self.arrived = time.time()
+        BufferedSockWriter.handle_lines(self, lines)
+
     def handle_line(self, line):
         """Handle a line. Pings are automatically handled
-        here. Run interested handlers on line."""
+        here, before anything else, and aren't logged.
+        Run interested handlers on line."""
         
-        self.log(line)
-        if 'PING' in line.upper():
-            line = line.split()
-            if len(line) == 3:
-                self.wline('PONG %s' % line[2])
-            else:
-                self.wline('PONG %s' % line[1])
+        if line.startswith('PING '):
+            self.pong(line[5:])
             return
+        self.logwire(line)
         if not line.strip():
             return
-        self.line = ParsedLine(line)
-        for handler in self.handlers:
+        self.line = ParsedLine(line, self.arrived)
+        if self.wirelog is not None:
+            self.wirelog.record(self.name, '<', line, self.line)
+        if self.line.verb == 'PING':
+            self.pong(self.line.rawparams)
+            return
+        if self.line.verb == 'PONG':
+            self.ponged(self.line)
+        if self.line.verb == 'CAP':
+            self.cap(self.line)
+        if self.phase != READY:
+            self.register_step(self.line)
+        if self.line.verb == '005':
+            self.supported(self.line)
+        if (self.line.verb == 'NICK' and self.line.args and self.nickname and
+                self.casemap.equal(self.line.nickname, self.nickname)):
+            self.nickname = self.line.args[0]
+            me = self.line.nickname
+            if self.line.user:
+                self.hostmask = '%s!%s@%s' % (self.nickname, self.line.user, self.line.host)
+        else:
+            me = self.nickname
+        if self.line.verb in ('JOIN', '396'):
+            self.learn_hostmask(self.line)
+        if self.tracker is not None:
+            self.tracker.update(self.line, me)
+        if self.line.verb == 'BATCH' and self.line.args:
+            self.batch_line(self.line)
+            return
+        if self.batches and self.line.rawtags:
+            batch = self.batches.get(self.line.tags().get('batch'))
+            if batch is not None:
+                batch.lines.append(self.line)
+                return
+        self.dispatch_line(self.line)
+
+    def batch_line(self, line):
+        """Start or end a batch. Ended batches are handed to the
+        handlers, or to the batch they're in."""
+
+        ref = line.args[0]
+        if ref.startswith('+'):
+            parent = None
+            if line.rawtags:
+                parent = self.batches.get(line.tags().get('batch'))
+            self.batches[ref[1:]] = Batch(ref[1:], (line.args[1:2] or [''])[0],
+                                          line.args[2:], parent)
+        elif ref.startswith('-'):
+            batch = self.batches.pop(ref[1:], None)
+            if batch is None:
+                return
+            line.batch = batch
+            if batch.parent is not None and batch.parent.ref in self.batches:
+                batch.parent.lines.append(line)
+            else:
+                self.dispatch_line(line)
+
+    def dispatch_line(self, line):
+        """Run the interested handlers on line."""
+
+        self.line = line
+        echo = ('echo-message' in self.caps and line.verb in ('PRIVMSG', 'NOTICE') and
+                self.nickname and self.casemap.equal(line.nickname, self.nickname))
+        for order, handler, args in self.dispatch_for(self.line):
+            if echo and not getattr(handler, 'echoes', False):
+                continue
+            self.line.cmdargs = args
             try:
-                if handler.interested(self.line, self.state):
-                    handler.run(self.line, self.state, self)
+                if self.profiler is not None and self.profiler.enabled:
+                    self.profile_handler(handler)
+                    continue
+                if self.timed:
+                    self.time_handler(handler)
+                    continue
+                interested = getattr(handler, 'interested', None)
+                if interested is None or interested(self.line, self.state):
+                    self.run_handler(handler, self.line)
             except ParseError, err:
                 self.reply("Failed to parse this line correctly."
                            " Maybe you haven't set your modes right?")
-                self.log(err)
+                self.logerror(err)
+
+    def time_handler(self, handler):
+        """Like the body of the loop in handle_line, but record how long
+        interested and run take in metrics."""
+
+        times = self.handlertimes.get(handler)
+        if times is None:
+            name = handler_name(handler)
+            times = self.handlertimes[handler] = (
+                metrics.registry.histogram('irc_handler_seconds', 'Time spent in handlers.',
+                                           handler=name, phase='interested'),
+                metrics.registry.histogram('irc_handler_seconds', 'Time spent in handlers.',
+                                           handler=name, phase='run'))
+        interested = getattr(handler, 'interested', None)
+        if interested is not None:
+            start = time.time()
+            wanted = interested(self.line, self.state)
+            times[0].observe(time.time() - start)
+            if not wanted:
+                return
+        start = time.time()
+        self.run_handler(handler, self.line)
+        times[1].observe(time.time() - start)
+
+    def profile_handler(self, handler):
+        """Like the body of the loop in handle_line, but let
+        the profiler time interested and run."""
+
+        name = handler_name(handler)
+        interested = getattr(handler, 'interested', None)
+        if interested is None or self.profiler.call(name, 'interested', interested,
+                                                    self.line, self.state):
+            self.profiler.call(name, 'run', self.run_handler, handler, self.line)
+
+    def run_handler(self, handler, line):
+        """Run handler on line. Override to change how
+        handlers are run."""
+
+        if self.workers is not None and getattr(handler, 'offload', False):
+            return self.workers.submit(self, handler, line)
+        return handler.run(line, self.state, self)
 
     def topic(self, channel, new=None):
         """Run the IRC topic command."""
@@ -190,7 +840,7 @@ class IRCProtocol(BufferedSockWriter):
         
         assert self.line
         target = self.line.target()
-        if target == self.state.nick():
+        if self.nickname and self.casemap.equal(target, self.nickname):
             self.privmsg(self.line.nick(),
                          message)
         else:
@@ -218,18 +868,51 @@ class IRCProtocol(BufferedSockWriter):
         
         self.wline('WHOWAS %s' % target)
 
-    def retry(self, tries=3):
-        """Try to reconnect and reregister again."""
-        
-        if tries > 0:
+    def retry(self):
+        """Reconnect and reregister, after a delay that grows with
+        every failed attempt (See connection.Backoff)."""
+
+        self.reconnect()
+        return True
+
+    def reconnect(self):
+        """See BufferedSockWriter.reconnect. Registration starts over."""
+
+        self.phase = OFFLINE
+        if self.registration is not None:
+            self.registration.cancel()
+            self.registration = None
+        if self.tracker is not None:
+            self.tracker.reset()
+        self.outbox = []
+        self.hostmask = None
+        self.offered.clear()
+        self.caps.clear()
+        self.requests = 0
+        self.batches.clear()
+        self.isupport.reset()
+        self.use_isupport()
+        BufferedSockWriter.reconnect(self)
+
+    def close(self, message=None):
+        """Say QUIT (With message), as far as the socket takes it
+        right away, and drop the connection for good (See
+        BufferedSockWriter.close)."""
+
+        if self.status == CONNECTED:
+            line = 'QUIT :%s' % message if message else 'QUIT'
+            self.logwire('>>> ' + line)
             try:
-                self.sock = self.sockmaker()
-                self.buf = ""
-                self.register()
-                return True
-            except socket.error, err:
-                self.log('Failed to reconnect with %s' % err)
-                self.retry(tries - 1)
+                # After the rest of a line that was partly written.
+                self.sock.send(self.pending + line + self.term)
+            except socket.error:
+                pass
+        self.phase = OFFLINE
+        if self.registration is not None:
+            self.registration.cancel()
+            self.registration = None
+        self.outbox = []
+        BufferedSockWriter.close(self)
 
     def usermode(self, user, mode):
         """Set modes on user."""
@@ -242,32 +925,113 @@ class IRCProtocol(BufferedSockWriter):
         self.wline('MODE %s %s' % (channel, mode))
 
     def channel_mode_user(self, channel, mode, user):
-        """Set a mode on user on channel."""
+        """Set a mode on user (Or each of a list of users) on channel.
+        A single mode, like '+o', is merged with the ones around it."""
         
-        self.wline('MODE %s %s %s' % (channel, mode, user))
+        if not isinstance(user, (list, tuple)):
+            user = [user]
+        if len(mode) == 2 and mode[0] in '+-':
+            self.queue('MODE', channel, *[(mode, nick) for nick in user])
+        else:
+            for nick in user:
+                self.wline('MODE %s %s %s' % (channel, mode, nick))
 
     def op(self, user, channel):
-        """Give user operator status on channel."""
+        """Give user (Or a list of users) operator status on channel."""
         
         self.channel_mode_user(channel, '+o', user)
 
     def deop(self, user, channel):
-        """Take away operator status from user on channel."""
+        """Take away operator status from user (Or a list of
+        users) on channel."""
         
         self.channel_mode_user(channel, '-o', user)
 
     def join(self, channel, key=None):
         """Join channel. If password protected, provide key."""
         
-        if key:
-            self.wline('JOIN %s %s' %(channel, key))
-        else:
-            self.wline('JOIN %s' % channel)
+        self.queue('JOIN', None, (channel, key))
 
     def part(self, channel):
         """Part channel."""
         
-        self.wline('PART %s' % channel)
+        self.queue('PART', None, channel)
+
+    def queue(self, command, key, *items):
+        """Send command with each of items at the end of this tick of the reactor (Right
+        away without one), on one line with the commands queued just
+        before it with the same command and key, as far as the limits
+        in self.isupport allow. Lines sent with wline in the meantime
+        make the queue go out first, so the order is kept.
+
+        PRIVMSG and NOTICE have the text as key and a target as item,
+        JOIN a (channel, key) and PART a channel as item, and MODE the
+        channel as key and a (mode, nick) as item."""
+
+        if not self.outbox and self.reactor is not None:
+            self.reactor.call_soon(self.flush_outbox)
+        self.outbox.extend((command, key, item) for item in items)
+        if self.reactor is None:
+            self.flush_outbox()
+
+    def flush_outbox(self):
+        """Send what's queued, merged into as few lines as may be."""
+
+        outbox, self.outbox = self.outbox, []
+        for (command, key), group in itertools.groupby(outbox, lambda entry: entry[:2]):
+            for line in self.pack(command, key, [entry[2] for entry in group]):
+                self.wline(line)
+
+    def pack(self, command, key, items):
+        """The lines for command with key, with items spread over as
+        few as the server allows (See queue)."""
+
+        if command == 'MODE':
+            limit = self.isupport.modes
+        else:
+            limit = self.isupport.targets(command)
+        room = self.isupport.linelen - len(self.term)
+        lines, chunk, seen = [], [], set()
+        for item in items:
+            if command == 'MODE':
+                name = None
+            else:
+                # Servers send to a target given twice only once.
+                name = self.casemap(item[0] if command == 'JOIN' else item)
+            if chunk and (limit is not None and len(chunk) >= limit or name in seen or
+                          len(self.render(command, key, chunk + [item])) > room):
+                lines.append(self.render(command, key, chunk))
+                chunk, seen = [], set()
+            chunk.append(item)
+            if name is not None:
+                seen.add(name)
+        if chunk:
+            lines.append(self.render(command, key, chunk))
+        return lines
+
+    def render(self, command, key, items):
+        """The line for command with key and items (See queue)."""
+
+        if command == 'MODE':
+            letters, nicks, sign = '', [], None
+            for mode, nick in items:
+                if mode[0] != sign:
+                    sign = mode[0]
+                    letters += sign
+                letters += mode[1:]
+                nicks.append(nick)
+            return 'MODE %s %s %s' % (key, letters, ' '.join(nicks))
+        if command == 'JOIN':
+            # Keys go with the first channels.
+            items = sorted(items, key=lambda item: not item[1])
+            channels = ','.join(channel for channel, password in items)
+            keys = ','.join(password for channel, password in items if password)
+            if keys:
+                return 'JOIN %s %s' % (channels, keys)
+            return 'JOIN %s' % channels
+        if command == 'PART':
+            return 'PART %s' % ','.join(items)
+        return '%s %s :%s' % (command, ','.join(items), key)
 
     def kick(self, channel, nick, comment=None):
         """Kick nick from channel, optionally providing a comment."""
@@ -286,9 +1050,9 @@ class IRCProtocol(BufferedSockWriter):
         """Run the IRC names command."""
         
         if isinstance(channels, list):
-            self.wline('LIST %s' % ','.join(channels))
+            self.wline('NAMES %s' % ','.join(channels))
         else:
-            self.wline('LIST %s' % channels)
+            self.wline('NAMES %s' % channels)
 
     def who(self, mask, operator=False):
         """Run the irc who command."""
@@ -308,9 +1072,24 @@ class IRCProtocol(BufferedSockWriter):
             self.wline('AWAY')
 
     def ping(self, target=None):
-        """Send a ping to target."""
+        """Send a ping to target (The server we're connected to if None).
+        When the PONG arrives, self.lag is set to the round trip time."""
         
-        if server is None:
-            self.wline('PING :%s' % self.dst)
-        else:
-            self.wline('PING :%s' % server)
+        if target is None:
+            target = self.dst
+        self.pings[target] = time.time()
+        self.wline_urgent('PING :%s' % target)
+
+    def pong(self, params):
+        """Answer a PING from the server, right away."""
+
+        self.wline_urgent('PONG %s' % params)
+
+    def ponged(self, line):
+        """Measure the lag if line answers our ping."""
+
+        if line.args:
+            sent = self.pings.pop(line.args[-1], None)
+            if sent is not None:
+                self.lag = time.time() - sent
+                self.lagged.set(self.lag)
@@ -3,7 +3,7 @@ num2rpl = {
     "002": "RPL_YOURHOST",
     "003": "RPL_CREATED",
     "004": "RPL_MYINFO",
-    "005": "RPL_BOUNCE",
+    "005": "RPL_ISUPPORT",
     "006": "RPL_MAP",
     "007": "RPL_MAPEND",
     "008": "RPL_SNOMASK",
@@ -0,0 +1,113 @@
+"""
+This module reads RPL_ISUPPORT (005), the lines a server sends
+after RPL_WELCOME to tell what it supports and what its limits are:
+
+CASEMAPPING - how nicks and channels are compared (See casemap).
+CHANTYPES - the characters channel names start with.
+PREFIX - the modes given to members of channels, and their prefixes.
+CHANMODES - which channel modes take a parameter.
+MODES - how many modes with a parameter a MODE line may have.
+TARGMAX, MAXTARGETS - how many targets a command may have.
+LINELEN - how long a line may be.
+NICKLEN - how long a nick may be.
+
+An ISupport starts out with what servers assume when they don't
+say (Mostly from the RFCs), and is updated from each 005 line.
+"""
+
+import re
+
+from tracker import LIST_MODES, PARAM_MODES, SET_PARAM_MODES, PREFIXES
+
+# Commands that took comma separated targets before TARGMAX was
+# invented, and how many they take then (None for no limit).
+TARGETS = {
+    'JOIN': None,
+    'PART': None,
+    'PRIVMSG': 1,
+    'NOTICE': 1,
+    }
+
+escape = re.compile(r'\\x([0-9A-Fa-f]{2})')
+
+def unescape(value):
+    """Undo the \\xHH escapes of an ISUPPORT value."""
+
+    return escape.sub(lambda match: chr(int(match.group(1), 16)), value)
+
+def number(value, default):
+    """value as an int, or default if it's empty (Or junk)."""
+
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+class ISupport(object):
+    """What a server told us it supports. The raw tokens are in
+    self.tokens, the ones this module knows are also parsed into
+    attributes of the same name, in lower case."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget what the server said, as when connecting again."""
+
+        self.tokens = {}
+        self.parse()
+
+    def update(self, params):
+        """Update from the parameters of a 005 line, without the
+        nick before and the text after them. -TOKEN takes TOKEN back."""
+
+        for token in params:
+            if token.startswith('-'):
+                self.tokens.pop(token[1:], None)
+            else:
+                key, _, value = token.partition('=')
+                self.tokens[key] = unescape(value)
+        self.parse()
+
+    def parse(self):
+        """Set the attributes from self.tokens."""
+
+        tokens = self.tokens
+        self.casemapping = tokens.get('CASEMAPPING') or 'rfc1459'
+        self.chantypes = tokens.get('CHANTYPES', '#&')
+        self.prefix = PREFIXES
+        modes, _, prefixes = tokens.get('PREFIX', '').partition(')')
+        if modes.startswith('(') and len(modes) - 1 == len(prefixes):
+            self.prefix = tuple(zip(modes[1:], prefixes))
+        chanmodes = tokens.get('CHANMODES', '').split(',')
+        if len(chanmodes) >= 3:
+            self.chanmodes = tuple(chanmodes[:3])
+        else:
+            self.chanmodes = (LIST_MODES, PARAM_MODES, SET_PARAM_MODES)
+        # MODES without a value means there's no limit.
+        self.modes = number(tokens.get('MODES', '3'), None)
+        self.linelen = number(tokens.get('LINELEN', ''), 512)
+        self.nicklen = number(tokens.get('NICKLEN', ''), 9)
+        self.targmax = None
+        if 'TARGMAX' in tokens:
+            self.targmax = {}
+            for pair in tokens['TARGMAX'].split(','):
+                command, _, limit = pair.partition(':')
+                if command:
+                    self.targmax[command.upper()] = number(limit, None)
+        self.maxtargets = number(tokens.get('MAXTARGETS', ''), None)
+
+    def targets(self, command):
+        """How many targets command may have, or None if any number."""
+
+        if self.targmax is not None:
+            # Commands it doesn't list take one.
+            return self.targmax.get(command, 1)
+        if command in ('PRIVMSG', 'NOTICE') and 'MAXTARGETS' in self.tokens:
+            return self.maxtargets
+        return TARGETS.get(command, 1)
+
+    def is_channel(self, name):
+        """Is name a channel, rather than a nick?"""
+
+        return bool(name) and name[0] in self.chantypes
@@ -0,0 +1,158 @@
+"""
+This module provides a logger that keeps file IO off the thread of
+the reactor. Events are queued, and a background thread formats and
+writes them in batches, with the timestamp formatted at most once
+per second. Events below the level of the logger are dropped before
+they're queued, and log files can be rotated by size or age.
+
+A Logger is a callable of one argument, like the loggers the rest of
+this library takes, with wire and error methods for raw protocol
+lines and errors. connection.makelogger makes one.
+"""
+
+import os
+import time
+import atexit
+import threading
+import collections
+
+WIRE = 5
+DEBUG = 10
+INFO = 20
+ERROR = 40
+
+class Logger(object):
+    """Logs events to a file from a background thread."""
+
+    def __init__(self, name, format='%Y %m %d %H:%M', level=WIRE,
+                 max_bytes=None, interval=None, backups=5,
+                 batch=512, flush_interval=0.5, max_queued=100000):
+        """Log to name (filepath), using format for timestamps.
+
+        level - events below this level are dropped.
+        max_bytes - rotate when the file grows past this size.
+        interval - rotate when the file is this many seconds old.
+        backups - how many rotated files to keep (name.1, name.2 ...).
+        batch - wake the writer when this many events are queued.
+        flush_interval - otherwise wake it this often (in seconds).
+        max_queued - drop the oldest events beyond this many.
+        """
+
+        self.name = name
+        self.format = format
+        self.level = level
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.backups = backups
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.events = collections.deque(maxlen=max_queued)
+        self.wakeup = threading.Event()
+        self.second = None
+        self.stamp = ''
+        self.open()
+        self.running = True
+        self.writer = threading.Thread(target=self.run, name='logger %s' % name)
+        self.writer.daemon = True
+        self.writer.start()
+        atexit.register(self.close)
+
+    def __call__(self, event, level=INFO):
+        """Log this event."""
+
+        if level < self.level:
+            return
+        self.events.append((time.time(), event))
+        if level >= ERROR or len(self.events) >= self.batch:
+            self.wakeup.set()
+
+    def wire(self, event):
+        """Log a raw protocol line."""
+
+        if self.level <= WIRE:
+            self(event, WIRE)
+
+    def error(self, event):
+        """Log an error."""
+
+        self(event, ERROR)
+
+    def set_level(self, level):
+        """Drop events below level from now on."""
+
+        self.level = level
+
+    def open(self):
+        """Open the log file for appending."""
+
+        self.logfile = open(self.name, 'a')
+        if self.interval is not None:
+            self.rollover = time.time() + self.interval
+
+    def timestamp(self, when):
+        """Formatted timestamp, cached for the current second."""
+
+        second = int(when)
+        if second != self.second:
+            self.second = second
+            self.stamp = time.strftime(self.format, time.localtime(when))
+        return self.stamp
+
+    def render(self, when, event):
+        """Turn an event into lines for the log."""
+
+        now = self.timestamp(when)
+        if isinstance(event, unicode):
+            event = event.encode('utf-8')
+        return ''.join("%s | %s\n" % (now, line) for line in str(event).split('\n'))
+
+    def run(self):
+        """Write queued events until closed."""
+
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Write all queued events at once."""
+
+        events = self.events
+        chunks = []
+        while events:
+            when, event = events.popleft()
+            chunks.append(self.render(when, event))
+        if not chunks:
+            return
+        self.logfile.write(''.join(chunks))
+        self.logfile.flush()
+        if self.max_bytes is not None and self.logfile.tell() >= self.max_bytes:
+            self.rotate()
+        elif self.interval is not None and time.time() >= self.rollover:
+            self.rotate()
+
+    def rotate(self):
+        """Move name to name.1, name.1 to name.2 and so on, and
+        start a new name."""
+
+        self.logfile.close()
+        for number in range(self.backups - 1, 0, -1):
+            older = '%s.%d' % (self.name, number)
+            if os.path.exists(older):
+                os.rename(older, '%s.%d' % (self.name, number + 1))
+        if self.backups > 0:
+            os.rename(self.name, '%s.1' % self.name)
+        else:
+            os.remove(self.name)
+        self.open()
+
+    def close(self):
+        """Write what's queued and stop the writer."""
+
+        if not self.running:
+            return
+        self.running = False
+        self.wakeup.set()
+        self.writer.join()
+        self.flush()
+        self.logfile.close()
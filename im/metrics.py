@@ -0,0 +1,350 @@
+"""
+This module provides counters, gauges and latency histograms for
+the hot paths of the library: selector.Reactor, the connection
+classes and irc.IRCProtocol.
+
+Metrics are off by default. Call enable() before making reactors and
+clients to turn them on; until then the registry hands out a metric
+that does nothing, and the timing code isn't run at all.
+
+The metrics can be served as Prometheus text on a local port, by
+adding an Exporter to a reactor, or logged now and then with
+dump_every.
+"""
+
+import socket
+import errno
+
+WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+class NullMetric(object):
+    """What the registry hands out when metrics are disabled."""
+
+    __slots__ = ()
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+NULL = NullMetric()
+
+class Counter(object):
+    """A value that only goes up."""
+
+    __slots__ = ('value',)
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        """Count amount more."""
+
+        self.value += amount
+
+    def samples(self, name, labels):
+        """Yield (name, labels, value) for rendering."""
+
+        yield name, labels, self.value
+
+class Gauge(Counter):
+    """A value that goes up and down."""
+
+    __slots__ = ()
+    kind = 'gauge'
+
+    def dec(self, amount=1):
+        """Subtract amount."""
+
+        self.value -= amount
+
+    def set(self, value):
+        """Set the value."""
+
+        self.value = value
+
+class Histogram(object):
+    """Latencies, counted in log-linear buckets like HdrHistogram's:
+    8 buckets per power of two microseconds, so any value is counted in
+    a bucket within 12.5% of it, in constant time and little memory."""
+
+    __slots__ = ('counts', 'count', 'sum')
+    kind = 'histogram'
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Count value, in seconds."""
+
+        micros = int(value * 1000000)
+        if micros < 16:
+            bucket = max(micros, 0)
+        else:
+            shift = micros.bit_length() - 4
+            bucket = shift * 8 + (micros >> shift)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += value
+
+    @staticmethod
+    def upper(bucket):
+        """The largest value, in seconds, counted in bucket."""
+
+        if bucket < 16:
+            return bucket / 1000000.0
+        shift = bucket // 8 - 1
+        top = bucket % 8 + 8
+        return (((top + 1) << shift) - 1) / 1000000.0
+
+    def quantile(self, q):
+        """Estimate the q-quantile (0 <= q <= 1), in seconds."""
+
+        if not self.count:
+            return 0.0
+        wanted = q * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= wanted:
+                return self.upper(bucket)
+        return self.upper(max(self.counts))
+
+    def samples(self, name, labels):
+        """Yield (name, labels, value) for rendering."""
+
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            le = labels + (('le', repr(self.upper(bucket))),)
+            yield name + '_bucket', le, seen
+        yield name + '_bucket', labels + (('le', '+Inf'),), self.count
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, self.count
+
+KINDS = {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}
+
+def escape(value):
+    """Escape a label value for the Prometheus text format."""
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Registry(object):
+    """Keeps the metrics, by name and labels."""
+
+    def __init__(self, enabled=False):
+        """Metrics are only kept if enabled."""
+
+        self.enabled = enabled
+        self.families = {}
+
+    def metric(self, kind, name, help='', **labels):
+        """Get the metric of kind (counter, gauge, histogram) called
+        name with labels, making it if needed."""
+
+        if not self.enabled:
+            return NULL
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = (kind, help, {})
+        key = tuple(sorted(labels.items()))
+        metric = family[2].get(key)
+        if metric is None:
+            metric = family[2][key] = KINDS[kind]()
+        return metric
+
+    def counter(self, name, help='', **labels):
+        """See metric."""
+
+        return self.metric('counter', name, help, **labels)
+
+    def gauge(self, name, help='', **labels):
+        """See metric."""
+
+        return self.metric('gauge', name, help, **labels)
+
+    def histogram(self, name, help='', **labels):
+        """See metric."""
+
+        return self.metric('histogram', name, help, **labels)
+
+    def render(self):
+        """All metrics in the Prometheus text format."""
+
+        out = []
+        for name in sorted(self.families):
+            kind, help, metrics = self.families[name]
+            out.append('# HELP %s %s' % (name, help))
+            out.append('# TYPE %s %s' % (name, kind))
+            for key in sorted(metrics):
+                for sample, labels, value in metrics[key].samples(name, key):
+                    if labels:
+                        labels = ','.join('%s="%s"' % (label, escape(text))
+                                          for label, text in labels)
+                        out.append('%s{%s} %r' % (sample, labels, value))
+                    else:
+                        out.append('%s %r' % (sample, value))
+        return '\n'.join(out) + '\n'
+
+registry = Registry()
+
+def enable():
+    """Start keeping metrics in registry."""
+
+    registry.enabled = True
+
+def disable():
+    """Stop handing out new metrics. Those already handed
+    out keep counting."""
+
+    registry.enabled = False
+
+class Exporter(object):
+    """A client for selector.Reactor serving the metrics over HTTP,
+    for Prometheus to scrape. Each connection is a client of the
+    reactor too (See Scrape), so a slow scraper stalls nobody."""
+
+    def __init__(self, port, host='127.0.0.1', registry=registry, timeout=5):
+        """Listen on host and port. Connections that haven't been
+        answered after timeout seconds are dropped."""
+
+        self.registry = registry
+        self.timeout = timeout
+        self.reactor = None
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(16)
+        self.sock.setblocking(0)
+
+    def set_reactor(self, reactor):
+        """Called by selector.Reactor when this is added to it."""
+
+        self.reactor = reactor
+
+    def id(self):
+        """Return fd of the listening socket."""
+
+        return self.sock.fileno()
+
+    def do_io(self):
+        """Accept whoever is connecting, and let the reactor
+        serve them."""
+
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error, err:
+                if err.args[0] in WOULDBLOCK:
+                    return
+                raise
+            self.reactor.addclient(Scrape(self, conn))
+
+    def retry(self):
+        """Keep listening."""
+
+        return True
+
+class Scrape(object):
+    """A connection to an Exporter: reads the request, then writes
+    the metrics, as the socket allows."""
+
+    def __init__(self, exporter, sock):
+        self.exporter = exporter
+        self.sock = sock
+        self.sock.setblocking(0)
+        self.request = ''
+        self.response = None
+        self.reactor = None
+        self.timer = None
+
+    def set_reactor(self, reactor):
+        """Called by selector.Reactor when this is added to it."""
+
+        self.reactor = reactor
+        self.timer = reactor.call_later(self.exporter.timeout, self.close)
+
+    def id(self):
+        """Return fd of the socket, or None once closed."""
+
+        if self.sock is None:
+            return None
+        return self.sock.fileno()
+
+    def do_io(self):
+        """Read the request, and render the metrics once it's in."""
+
+        if self.sock is None or self.response is not None:
+            return
+        try:
+            data = self.sock.recv(4096)
+        except socket.error, err:
+            if err.args[0] in WOULDBLOCK:
+                return
+            raise
+        if not data:
+            self.close()
+            return
+        self.request += data
+        if '\n\r\n' in self.request or '\n\n' in self.request or len(self.request) > 65536:
+            body = self.exporter.registry.render()
+            self.response = ('HTTP/1.0 200 OK\r\n'
+                             'Content-Type: text/plain; version=0.0.4\r\n'
+                             'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+            self.reactor.want_write(self)
+
+    def wants_write(self):
+        """True while there's some of the response left to write."""
+
+        return bool(self.response)
+
+    def do_write(self):
+        """Write what the socket takes of the response, and
+        close once it's all written."""
+
+        if self.sock is None:
+            return
+        try:
+            sent = self.sock.send(self.response)
+        except socket.error, err:
+            if err.args[0] in WOULDBLOCK:
+                return
+            raise
+        self.response = self.response[sent:]
+        if not self.response:
+            self.close()
+
+    def close(self):
+        """Hang up, and leave the reactor."""
+
+        if self.sock is None:
+            return
+        self.reactor.removeclient(self)
+        self.retry()
+
+    def retry(self):
+        """The connection failed (Or is done), close it for good."""
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        return False
+
+def dump_every(reactor, interval, logger, registry=registry):
+    """Log the metrics with logger every interval seconds, using
+    the timers of reactor. Returns a handle, to cancel it with."""
+
+    return reactor.call_every(interval, lambda: logger(registry.render()))
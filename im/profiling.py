@@ -0,0 +1,139 @@
+"""
+This module helps find the handlers that make a bot sluggish.
+
+A HandlerProfiler given to irc.IRCProtocol.set_profiler records the
+wall and CPU time of every interested and run call. When a call takes
+longer than a threshold, the next few calls of that handler are run
+under cProfile, so the report can say where the time goes. It can be
+turned on and off at runtime, with set_profiler, its enabled flag or
+a signal (See toggle_on_signal).
+"""
+
+import time
+import signal
+import pstats
+import cProfile
+from StringIO import StringIO
+
+class HandlerStats(object):
+    """Time spent in one phase (interested or run) of one handler."""
+
+    __slots__ = ('calls', 'wall', 'cpu', 'slowest')
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.slowest = 0.0
+
+    def add(self, wall, cpu):
+        """Account for a call."""
+
+        self.calls += 1
+        self.wall += wall
+        self.cpu += cpu
+        if wall > self.slowest:
+            self.slowest = wall
+
+class HandlerProfiler(object):
+    """Times handler calls and profiles slow handlers."""
+
+    def __init__(self, threshold=0.05, samples=5, top=10, logger=None):
+        """Calls slower than threshold seconds get the next samples
+        calls (Of interested or run) of the handler profiled.
+        Reports list the top slowest handlers, and are logged
+        with logger."""
+
+        self.threshold = threshold
+        self.samples = samples
+        self.top = top
+        self.logger = logger
+        self.enabled = True
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far."""
+
+        self.stats = {}
+        self.sampling = {}
+        self.profiles = {}
+
+    def toggle(self, *ignored):
+        """Turn profiling on if it's off, and off if it's on.
+        Takes and ignores arguments, so it can be a signal handler."""
+
+        self.enabled = not self.enabled
+
+    def call(self, name, phase, func, *args):
+        """Call func with args, as phase of the handler called name,
+        and return what it returns."""
+
+        sampling = self.sampling.get(name, 0)
+        profile = None
+        wall, cpu = time.time(), time.clock()
+        if sampling:
+            profile = cProfile.Profile()
+            result = profile.runcall(func, *args)
+        else:
+            result = func(*args)
+        wall, cpu = time.time() - wall, time.clock() - cpu
+        stats = self.stats.get((name, phase))
+        if stats is None:
+            stats = self.stats[(name, phase)] = HandlerStats()
+        stats.add(wall, cpu)
+        if profile is not None:
+            self.sampling[name] = sampling - 1
+            if name in self.profiles:
+                self.profiles[name].add(profile)
+            else:
+                self.profiles[name] = pstats.Stats(profile)
+        elif wall > self.threshold and name not in self.profiles:
+            self.sampling[name] = self.samples
+        return result
+
+    def report(self, top=None):
+        """A report of the top slowest handlers, by total wall time,
+        with the profiles sampled for them."""
+
+        if top is None:
+            top = self.top
+        slowest = sorted(self.stats.items(), key=lambda item: -item[1].wall)[:top]
+        out = StringIO()
+        out.write('Slowest handlers:\n')
+        out.write('%-24s %-10s %8s %10s %10s %10s %10s\n' %
+                  ('handler', 'phase', 'calls', 'wall', 'mean', 'max', 'cpu'))
+        for (name, phase), stats in slowest:
+            out.write('%-24s %-10s %8d %10.4f %10.6f %10.4f %10.4f\n' %
+                      (name, phase, stats.calls, stats.wall,
+                       stats.wall / stats.calls, stats.slowest, stats.cpu))
+        names = set(name for (name, phase), stats in slowest)
+        for name in sorted(names & set(self.profiles)):
+            out.write('\nProfile of %s:\n' % name)
+            profile = self.profiles[name]
+            profile.stream = out
+            profile.sort_stats('cumulative').print_stats(10)
+        return out.getvalue()
+
+    def log_report(self):
+        """Log a report, if there's anything to report."""
+
+        if self.logger and self.stats:
+            self.logger(self.report())
+
+    def report_every(self, reactor, interval):
+        """Log a report every interval seconds, using the timers
+        of reactor. Returns a handle, to cancel it with."""
+
+        def report():
+            if self.enabled:
+                self.log_report()
+        return reactor.call_every(interval, report)
+
+    def toggle_on_signal(self, signum=signal.SIGUSR2):
+        """Toggle profiling when the process gets signal signum.
+        selector.Reactor.tick takes a poll the signal interrupts as
+        one that found nothing ready; other system calls it interrupts
+        are restarted."""
+
+        signal.signal(signum, self.toggle)
+        signal.siginterrupt(signum, False)
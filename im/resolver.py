@@ -0,0 +1,85 @@
+"""
+This module resolves host names on a small pool of threads, so a
+slow DNS server doesn't stop the reactor, and caches the answers.
+
+Lookups of the same name that overlap are only made once. Answers
+(And failures, for a shorter while) are kept for ttl seconds.
+connection.LineReciever uses the default resolver, unless given
+another with set_resolver.
+"""
+
+import time
+import socket
+import threading
+from multiprocessing.pool import ThreadPool
+
+def lookup(host, port):
+    """Resolve host, in a worker. Returns (addresses, error), where
+    addresses is a list of (family, sockaddr) to connect to."""
+
+    try:
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    except socket.error, err:
+        return [], err
+    return [(family, sockaddr) for family, _, _, _, sockaddr in infos], None
+
+class Resolver(object):
+    """Resolves names on threads, and remembers the answers."""
+
+    def __init__(self, workers=4, ttl=300, negative_ttl=10):
+        """workers is the size of the pool, made when first needed.
+        Answers are cached for ttl seconds, failures for negative_ttl."""
+
+        self.workers = workers
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.pool = None
+        self.cache = {}
+        self.waiting = {}
+        # Clients on several reactors (See shard) may share a resolver.
+        self.lock = threading.Lock()
+
+    def resolve(self, host, port, reactor, callback):
+        """Resolve host, and call callback with (addresses, error) on
+        the thread of reactor. Call this on the thread of reactor."""
+
+        key = (host, port)
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] > time.time():
+                reactor.call_soon(callback, cached[1], cached[2])
+                return
+            if key in self.waiting:
+                self.waiting[key].append((reactor, callback))
+                return
+            self.waiting[key] = [(reactor, callback)]
+            if self.pool is None:
+                self.pool = ThreadPool(self.workers)
+        self.pool.apply_async(lookup, key, callback=lambda result: self.done(key, result))
+
+    def done(self, key, result):
+        """A worker resolved key. Cache the result and hand it to
+        everyone waiting for it, on their reactors."""
+
+        addresses, error = result
+        if error is None:
+            expires = time.time() + self.ttl
+        else:
+            expires = time.time() + self.negative_ttl
+        with self.lock:
+            self.cache[key] = (expires, addresses, error)
+            waiting = self.waiting.pop(key, ())
+        for reactor, callback in waiting:
+            reactor.call_soon_threadsafe(callback, addresses, error)
+
+    def forget(self, host=None, port=None):
+        """Drop the cached answer for host and port, or every
+        cached answer if host is None."""
+
+        with self.lock:
+            if host is None:
+                self.cache.clear()
+            else:
+                self.cache.pop((host, port), None)
+
+default = Resolver()
@@ -0,0 +1,115 @@
+"""
+This module provides a router for bot commands, like !remind, found
+at the start of messages.
+
+All the triggers registered with a Router are compiled into a dict
+of words, a trie of prefixes and one combined regular expression, so
+a message is matched against all of them in one go, however many
+handlers there are. Used by irc.IRCProtocol to dispatch to handlers
+with triggers, prefixes or patterns attributes.
+"""
+
+import re
+
+BACKREFERENCE = re.compile(r'\\\d|\(\?P=')
+
+class Router(object):
+    """Matches messages against the triggers of handlers.
+
+    A handler may have any of these attributes:
+    triggers - words that must be the first word of the message.
+               The arguments are the rest of the words.
+    prefixes - strings the message must start with.
+               The arguments are the words after the prefix.
+    patterns - regular expressions (Strings or compiled) searched for
+               in the message. The arguments are the groups of the
+               match, or the words after it when it has no groups.
+    """
+
+    def __init__(self):
+        """Make an empty router."""
+
+        self.words = {}
+        self.trie = {}
+        self.patterns = []
+        self.combined = None
+
+    def add(self, handler, order):
+        """Add the triggers of handler. order decides the order
+        matching handlers are returned in."""
+
+        for word in getattr(handler, 'triggers', None) or ():
+            self.words.setdefault(word, []).append((order, handler))
+        for prefix in getattr(handler, 'prefixes', None) or ():
+            node = self.trie
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node.setdefault(None, []).append((order, handler))
+        for pattern in getattr(handler, 'patterns', None) or ():
+            if isinstance(pattern, basestring):
+                pattern = re.compile(pattern)
+            self.patterns.append((order, pattern, handler))
+        self.compile()
+
+    def compile(self):
+        """Combine the patterns into one regular expression, used to
+        skip all of them at once for messages none of them match."""
+
+        self.patterns.sort()
+        sources = []
+        for order, pattern, handler in self.patterns:
+            if (pattern.flags & ~(re.UNICODE | re.LOCALE) or pattern.groupindex or
+                    BACKREFERENCE.search(pattern.pattern)):
+                # Can't be combined without changing its meaning (Or,
+                # for named groups, clashing with another pattern's).
+                self.combined = None
+                return
+            sources.append('(?:%s)' % pattern.pattern)
+        self.combined = None
+        if sources:
+            try:
+                self.combined = re.compile('|'.join(sources))
+            except re.error:
+                pass
+
+    def __len__(self):
+        """Number of triggers."""
+
+        return len(self.words) + len(self.patterns) + bool(self.trie)
+
+    def match(self, message):
+        """Return a sorted list of (order, handler, args) for the
+        handlers whose triggers match message. A handler is returned
+        at most once, for the first of its triggers that matched."""
+
+        found = {}
+        words = message.split(None, 1)
+        if words and words[0] in self.words:
+            if len(words) > 1:
+                args = words[1].split()
+            else:
+                args = []
+            for order, handler in self.words[words[0]]:
+                found[order] = (order, handler, args)
+        node = self.trie
+        for end, char in enumerate(message):
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                args = message[end + 1:].split()
+                for order, handler in node[None]:
+                    if order not in found:
+                        found[order] = (order, handler, args)
+        if self.patterns and (self.combined is None or self.combined.search(message)):
+            for order, pattern, handler in self.patterns:
+                if order in found:
+                    continue
+                match = pattern.search(message)
+                if match is None:
+                    continue
+                args = list(match.groups())
+                if not args:
+                    args = message[match.end():].split()
+                found[order] = (order, handler, args)
+        return sorted(found.values())
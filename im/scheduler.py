@@ -0,0 +1,144 @@
+"""
+This module provides the timers of selector.Reactor: a min-heap of
+deadlines, with handles that can be cancelled.
+
+Scheduling and cancelling are O(log n) and O(1). Cancelled timers
+stay in the heap until they come up, unless they make up most of
+it, in which case it's rebuilt without them, so thousands of timers
+that mostly get cancelled (Like ping timeouts) don't pile up.
+"""
+
+import time
+import heapq
+import itertools
+
+class TimerHandle(object):
+    """A scheduled call, which can be cancelled."""
+
+    __slots__ = ('deadline', 'seq', 'callback', 'args', 'interval',
+                 'cancelled', 'scheduler')
+
+    def __init__(self, scheduler, deadline, seq, callback, args, interval=None):
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.seq = seq
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+
+    def __lt__(self, other):
+        """Order by deadline, then by when it was scheduled."""
+
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
+
+    def cancel(self):
+        """Don't make the call (Or any more calls, if it repeats).
+        Cancelling twice, or after the call, does nothing."""
+
+        if not self.cancelled:
+            self.cancelled = True
+            self.scheduler.cancelled(self)
+
+class Scheduler(object):
+    """Runs callbacks when their time has come."""
+
+    def __init__(self, clock=time.time):
+        """clock returns the time, in seconds."""
+
+        self.clock = clock
+        self.heap = []
+        self.seq = itertools.count()
+        self.dead = 0
+
+    def __len__(self):
+        """How many calls are scheduled."""
+
+        return len(self.heap) - self.dead
+
+    def call_at(self, when, callback, *args):
+        """Call callback with args at time when. Returns a TimerHandle."""
+
+        handle = TimerHandle(self, when, self.seq.next(), callback, args)
+        heapq.heappush(self.heap, handle)
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        """Call callback with args after delay seconds.
+        Returns a TimerHandle."""
+
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def call_every(self, interval, callback, *args):
+        """Call callback with args every interval seconds, starting
+        interval seconds from now, until the returned TimerHandle is
+        cancelled. Calls that would be late are skipped, not bunched."""
+
+        handle = TimerHandle(self, self.clock() + interval, self.seq.next(),
+                             callback, args, interval)
+        heapq.heappush(self.heap, handle)
+        return handle
+
+    def cancelled(self, handle):
+        """handle was cancelled. Rebuild the heap if it's mostly
+        cancelled timers."""
+
+        if handle.seq < 0:
+            # It's not in the heap, it ran or is about to.
+            return
+        self.dead += 1
+        if self.dead > 64 and self.dead * 2 > len(self.heap):
+            self.heap = [live for live in self.heap if not live.cancelled]
+            heapq.heapify(self.heap)
+            self.dead = 0
+
+    def next_deadline(self):
+        """When the next call is due, or None if there are none."""
+
+        heap = self.heap
+        while heap and heap[0].cancelled:
+            heapq.heappop(heap)
+            self.dead -= 1
+        if heap:
+            return heap[0].deadline
+        return None
+
+    def timeout(self, timeout=None):
+        """How long a poller may block (At most timeout seconds,
+        unless it's None) without making a call late."""
+
+        deadline = self.next_deadline()
+        if deadline is None:
+            return timeout
+        until = max(deadline - self.clock(), 0)
+        if timeout is None:
+            return until
+        return min(timeout, until)
+
+    def run(self):
+        """Make the calls that are due. Calls scheduled by them for
+        now or earlier wait for the next run."""
+
+        heap = self.heap
+        now = self.clock()
+        due = []
+        while heap and heap[0].deadline <= now:
+            handle = heapq.heappop(heap)
+            if handle.cancelled:
+                self.dead -= 1
+            else:
+                # Out of the heap, see cancelled.
+                handle.seq = -1
+                due.append(handle)
+        for handle in due:
+            if handle.cancelled:
+                # Cancelled by an earlier call in this run.
+                continue
+            if handle.interval is not None:
+                handle.deadline += handle.interval
+                if handle.deadline <= now:
+                    handle.deadline = now + handle.interval
+                handle.seq = self.seq.next()
+                heapq.heappush(self.heap, handle)
+            handle.callback(*handle.args)
+        return len(due)
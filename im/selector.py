@@ -10,13 +10,238 @@ has been 'stolen' from there.
 
 import socket
 import select
+import time
+import os
+import fcntl
+import errno
+import collections
+
+from scheduler import Scheduler
+import metrics
+
+READ = 1
+WRITE = 4
+
+class EpollPoller(object):
+    """Poller backed by select.epoll (Linux)."""
+
+    def __init__(self):
+        """Create the epoll object."""
+
+        self.epoll = select.epoll()
+        self.masks = {READ: select.EPOLLIN | select.EPOLLPRI,
+                      WRITE: select.EPOLLOUT}
+        self.inmask = select.EPOLLIN | select.EPOLLPRI | select.EPOLLHUP | select.EPOLLERR
+        self.outmask = select.EPOLLOUT
+
+    def _mask(self, events):
+        """Translate READ/WRITE flags into an epoll mask."""
+
+        mask = 0
+        if events & READ:
+            mask |= self.masks[READ]
+        if events & WRITE:
+            mask |= self.masks[WRITE]
+        return mask
+
+    def register(self, fd, events):
+        """Start watching fd for events."""
+
+        self.epoll.register(fd, self._mask(events))
+
+    def modify(self, fd, events):
+        """Change the events watched for on fd."""
+
+        self.epoll.modify(fd, self._mask(events))
+
+    def unregister(self, fd):
+        """Stop watching fd."""
+
+        self.epoll.unregister(fd)
+
+    def poll(self, timeout=None):
+        """Return a list of (fd, events) that are ready."""
+
+        if timeout is None:
+            timeout = -1
+        ready = []
+        for fd, mask in self.epoll.poll(timeout):
+            events = 0
+            if mask & self.inmask:
+                events |= READ
+            if mask & self.outmask:
+                events |= WRITE
+            ready.append((fd, events))
+        return ready
+
+class PollPoller(object):
+    """Poller backed by select.poll."""
+
+    def __init__(self):
+        """Create the poll object."""
+
+        self.pollobj = select.poll()
+        self.inmask = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+        self.outmask = select.POLLOUT
+
+    def _mask(self, events):
+        """Translate READ/WRITE flags into a poll mask."""
+
+        mask = 0
+        if events & READ:
+            mask |= select.POLLIN | select.POLLPRI
+        if events & WRITE:
+            mask |= select.POLLOUT
+        return mask
+
+    def register(self, fd, events):
+        """Start watching fd for events."""
+
+        self.pollobj.register(fd, self._mask(events))
+
+    def modify(self, fd, events):
+        """Change the events watched for on fd."""
+
+        self.pollobj.register(fd, self._mask(events))
+
+    def unregister(self, fd):
+        """Stop watching fd."""
+
+        self.pollobj.unregister(fd)
+
+    def poll(self, timeout=None):
+        """Return a list of (fd, events) that are ready."""
+
+        if timeout is not None:
+            timeout = timeout * 1000
+        ready = []
+        for fd, mask in self.pollobj.poll(timeout):
+            events = 0
+            if mask & self.inmask:
+                events |= READ
+            if mask & self.outmask:
+                events |= WRITE
+            ready.append((fd, events))
+        return ready
+
+class SelectPoller(object):
+    """Poller backed by select.select. Limited to FD_SETSIZE
+    file descriptors, so only used when nothing better exists."""
+
+    def __init__(self):
+        """Start with empty read and write sets."""
+
+        self.readers = set()
+        self.writers = set()
+
+    def register(self, fd, events):
+        """Start watching fd for events."""
+
+        if events & READ:
+            self.readers.add(fd)
+        if events & WRITE:
+            self.writers.add(fd)
+
+    def modify(self, fd, events):
+        """Change the events watched for on fd."""
+
+        self.unregister(fd)
+        self.register(fd, events)
+
+    def unregister(self, fd):
+        """Stop watching fd."""
+
+        self.readers.discard(fd)
+        self.writers.discard(fd)
+
+    def poll(self, timeout=None):
+        """Return a list of (fd, events) that are ready."""
+
+        readable, writable, _ = select.select(self.readers, self.writers, [], timeout)
+        events = {}
+        for fd in readable:
+            events[fd] = READ
+        for fd in writable:
+            events[fd] = events.get(fd, 0) | WRITE
+        return events.items()
+
+def best_poller():
+    """Return an instance of the best poller available on this platform."""
+
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    if hasattr(select, 'poll'):
+        return PollPoller()
+    return SelectPoller()
+
+class Waker(object):
+    """A client for Reactor that lets other threads have callbacks
+    run on the thread of the reactor, waking it up with a byte
+    written to a pipe. Every Reactor has one, see
+    Reactor.call_soon_threadsafe."""
+
+    def __init__(self):
+        """Make the pipe."""
+
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.calls = collections.deque()
+
+    def id(self):
+        """Return the read end of the pipe."""
+
+        return self.rfd
+
+    def call(self, callback, *args):
+        """Run callback with args on the reactor thread, soon.
+        Safe to call from any thread."""
+
+        self.calls.append((callback, args))
+        self.wake()
+
+    def wake(self):
+        """Wake the reactor up, if it's waiting for events."""
+
+        try:
+            os.write(self.wfd, 'x')
+        except OSError, err:
+            # A full pipe will wake the reactor anyway.
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def do_io(self):
+        """Empty the pipe and run the callbacks."""
+
+        try:
+            os.read(self.rfd, 4096)
+        except OSError, err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        self.run_calls()
+
+    def run_calls(self):
+        """Run the callbacks queued so far. Those queued while they
+        run wait for the next time, so a callback queueing itself
+        can't keep the reactor from polling."""
+
+        calls = self.calls
+        for _ in xrange(len(calls)):
+            callback, args = calls.popleft()
+            callback(*args)
+
+    def retry(self):
+        """The pipe doesn't break, keep it."""
+
+        return True
 
 class Reactor(object):
-    """This class runs a select-loop to check if
+    """This class runs a poll-loop to check if
     file descriptors have input, and if they do,
     it notifies the client the fd belongs to."""
-    
-    def __init__(self, clients=None, logger=None):
+
+    def __init__(self, clients=None, logger=None, poller=None, name='reactor'):
         """Instanciate a Reactor with a list of clients,
         and a logger, both of which may be None.
 
@@ -24,6 +249,9 @@ class Reactor(object):
         client.id() - should return a valid file descriptor.
                       in Python most file-like objects can give
                       you their fd by calling object.fileno().
+                      None means there's nothing to watch for
+                      now (Like while waiting to reconnect), the
+                      client calls reregister when there is.
         client.do_io() - client should deal with it's io,
                          by reading it and stowing it away in a
                          buffer, or reacting to it in some way.
@@ -31,45 +259,225 @@ class Reactor(object):
                          and should try to fix it's problem.
                          If this returns a false value, it is removed
                          from the list of clients.
+        Clients that write may also support:
+        client.set_reactor(reactor) - called when the client is added,
+                                      so it can call want_write and
+                                      call_later (Or call_at and
+                                      call_every) on the reactor.
+        client.wants_write() - return a true value if the client has
+                               output waiting.
+        client.do_write() - the fd of client is writable, so it
+                            should flush (some of) its output.
         A logger is simply a callable of one argument, and it's
         obviously meant to log that argument (Which may be a string,
         or an exception).
+
+        poller is an object like the ones returned by best_poller,
+        which is used when it's None. name labels the metrics of
+        this reactor (See metrics).
+
+        Other threads must not call addclient and removeclient, but
+        add_client, remove_client and call_soon_threadsafe, which
+        wake the reactor up through a pipe (See Waker).
         """
-        if clients is None:
-            self.clients = []
-        else:
-            self.clients = clients
+        if poller is None:
+            poller = best_poller()
+        self.poller = poller
+        self.clients = []
+        self.fdmap = {}
+        self.clientfds = {}
+        self.writers = set()
+        self.scheduler = Scheduler()
+        self.waker = Waker()
         self.logger = logger
+        self.timed = metrics.registry.enabled
+        self.polltime = metrics.registry.histogram(
+            'reactor_poll_seconds', 'Time spent waiting for events.', reactor=name)
+        self.dispatchtime = metrics.registry.histogram(
+            'reactor_dispatch_seconds', 'Time spent handling events and timers.', reactor=name)
+        self.events = metrics.registry.counter(
+            'reactor_events_total', 'Ready fds handled.', reactor=name)
+        self.nclients = metrics.registry.gauge(
+            'reactor_clients', 'Clients of the reactor.', reactor=name)
+        self._watch(self.waker)
+        if clients is not None:
+            for client in clients:
+                self.addclient(client)
 
     def addclient(self, client):
         """Add a client to this reactor."""
-        
+
         self.clients.append(client)
-        
+        self.nclients.set(len(self.clients))
+        if hasattr(client, 'set_reactor'):
+            client.set_reactor(self)
+        self._watch(client)
+
+    def _watch(self, client):
+        """Start watching the current fd of client, if it has one."""
+
+        fd = client.id()
+        if fd is None:
+            return
+        self.fdmap[fd] = client
+        self.clientfds[client] = fd
+        events = READ
+        if hasattr(client, 'wants_write') and client.wants_write():
+            self.writers.add(client)
+            events |= WRITE
+        self.poller.register(fd, events)
+
+    def _forget(self, client):
+        """Stop watching the fd client was registered with."""
+
+        self.writers.discard(client)
+        fd = self.clientfds.pop(client, None)
+        if fd is None:
+            return
+        del self.fdmap[fd]
+        try:
+            self.poller.unregister(fd)
+        except (IOError, OSError, KeyError, ValueError):
+            # The fd was most likely closed already.
+            pass
+
+    def removeclient(self, client):
+        """Remove a client from this reactor."""
+
+        self._forget(client)
+        self.clients.remove(client)
+        self.nclients.set(len(self.clients))
+
+    def add_client(self, client):
+        """Add a client to this reactor, from any thread."""
+
+        self.call_soon_threadsafe(self.addclient, client)
+
+    def remove_client(self, client):
+        """Remove a client from this reactor, from any thread. It's
+        fine if it's gone already."""
+
+        self.call_soon_threadsafe(self.discard, client)
+
+    def discard(self, client):
+        """Remove client, if it's still a client of this reactor."""
+
+        if client in self.clients:
+            self.removeclient(client)
+
+    def call_soon(self, callback, *args):
+        """Call callback with args at the end of this tick (Or the
+        next, if not in one). Only call this on the reactor thread."""
+
+        self.waker.calls.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Call callback with args on the reactor thread, soon,
+        waking the reactor up if it's waiting for events."""
+
+        self.waker.call(callback, *args)
+
+    def reregister(self, client):
+        """The fd of client has changed (It reconnected, or lost its
+        connection), so stop watching the old one and start watching
+        the new."""
+
+        self._forget(client)
+        self._watch(client)
+
+    def want_write(self, client, flag=True):
+        """Tell the reactor whether client wants to know when
+        its fd is writable."""
+
+        fd = self.clientfds.get(client)
+        if fd is None or flag == (client in self.writers):
+            return
+        if flag:
+            self.writers.add(client)
+            self.poller.modify(fd, READ | WRITE)
+        else:
+            self.writers.discard(client)
+            self.poller.modify(fd, READ)
+
+    def call_later(self, delay, callback, *args):
+        """Call callback with args after delay seconds. Returns a
+        scheduler.TimerHandle, which can be cancelled."""
+
+        return self.scheduler.call_later(delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        """Call callback with args at time when (As returned by
+        time.time). Returns a scheduler.TimerHandle."""
+
+        return self.scheduler.call_at(when, callback, *args)
+
+    def call_every(self, interval, callback, *args):
+        """Call callback with args every interval seconds, until the
+        returned scheduler.TimerHandle is cancelled."""
+
+        return self.scheduler.call_every(interval, callback, *args)
+
+    def run_timers(self):
+        """Run the callbacks whose time has come."""
+
+        self.scheduler.run()
+
+    def poll_timeout(self, timeout=None):
+        """How long the poller may block without making a timer
+        or a deferred call late."""
+
+        if self.waker.calls:
+            return 0
+        return self.scheduler.timeout(timeout)
+
     def log(self, event):
         """Log event."""
         if self.logger:
             self.logger(event)
-            
-    def tick(self):
-        """Perform one tick of the select loop."""
-        
-        assert self.clients
-        filenos = [client.id() for client in self.clients]
-        inputs = select.select(filenos, [], [])[0]
-        for input in inputs:
-            client = filter(lambda client: client.id() == input, self.clients)[0]
+
+    def tick(self, timeout=None):
+        """Perform one tick of the poll loop: wait for events (At most
+        timeout seconds, if given), handle them, then run the timers
+        that are due and the deferred calls (See call_soon)."""
+
+        if self.timed:
+            start = time.time()
+        try:
+            ready = self.poller.poll(self.poll_timeout(timeout))
+        except (IOError, OSError, select.error), err:
+            if err.args[0] != errno.EINTR:
+                raise
+            # A signal (Like the one profiling.HandlerProfiler toggles
+            # on) interrupted the poll: nothing is ready.
+            ready = []
+        if self.timed:
+            polled = time.time()
+            self.polltime.observe(polled - start)
+            self.events.inc(len(ready))
+        for fd, events in ready:
+            client = self.fdmap.get(fd)
+            if client is None:
+                continue
             try:
-                client.do_io()
+                if events & WRITE:
+                    client.do_write()
+                if events & READ:
+                    client.do_io()
             except (IOError, socket.error), err:
                 self.log(err)
-                if not client.retry():
+                self._forget(client)
+                if client.retry():
+                    self._watch(client)
+                else:
                     self.clients.remove(client)
+                    self.nclients.set(len(self.clients))
+        self.run_timers()
+        self.waker.run_calls()
+        if self.timed:
+            self.dispatchtime.observe(time.time() - polled)
 
     def loop(self):
         """Loop indefinitely, calling self.tick."""
-        
+
         while True:
             self.tick()
-            
-                
@@ -0,0 +1,456 @@
+"""
+This module spreads connections over several selector.Reactors, each
+with its own poller, on threads or processes, so one bot can keep
+thousands of connections and use every core.
+
+A Supervisor starts the shards and hands each new connection to the
+shard with the least traffic. Connections are known by a key, can be
+added and removed at runtime, and lines can be sent to a connection
+on any shard with Supervisor.send (Or client.shard.send, from a
+handler, as every client gets a shard attribute when it's added).
+
+Thread shards share the process, so connections are moved from busy
+shards to quiet ones by rebalance, when they have nothing scheduled on
+the reactor they're leaving (See movable). Process shards don't share the GIL,
+but can't move connections: they're made in the shard process by a
+factory, from a spec that can be pickled, and lines for them travel
+over a pipe.
+"""
+
+import threading
+import multiprocessing
+
+from selector import Reactor
+from connection import CONNECTED
+from irc import READY
+
+def movable(client):
+    """Can client move to another reactor without leaving work behind
+    on this one? Only if it's connected, registered, and has no timers
+    (Connecting, registering, flood control), queued output (See
+    irc.IRCProtocol.queue) or worker pool (Which replays handlers on
+    its own reactor). Call on the thread of the reactor of client."""
+
+    return (getattr(client, 'status', None) == CONNECTED and
+            getattr(client, 'phase', READY) == READY and
+            getattr(client, 'timer', None) is None and
+            getattr(client, 'registration', None) is None and
+            getattr(client, 'unthrottler', None) is None and
+            not getattr(client, 'outbox', None) and
+            getattr(client, 'workers', None) is None)
+
+def close(client):
+    """Drop the connection of a client removed for good (Saying
+    QUIT, for an irc.IRCProtocol), and cancel its timers."""
+
+    if hasattr(client, 'close'):
+        client.close()
+
+class ThreadShard(object):
+    """A reactor running on a thread of its own."""
+
+    def __init__(self, supervisor, number, interval, logger=None):
+        """Measure the traffic of the clients every interval seconds."""
+
+        self.supervisor = supervisor
+        self.number = number
+        self.interval = interval
+        self.reactor = Reactor(logger=logger, name='shard%d' % number)
+        # Only used on the shard thread.
+        self.clients = {}
+        self.seen = {}
+        # Read by the supervisor, replaced (Not changed) by the shard.
+        self.rates = {}
+        self.load = 0.0
+        # Only used by the supervisor.
+        self.keys = set()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='shard %d' % number)
+        self.thread.daemon = True
+
+    def start(self):
+        """Start the thread."""
+
+        self.reactor.call_every(self.interval, self.sample)
+        self.thread.start()
+
+    def run(self):
+        """Run the reactor until stopped."""
+
+        while self.running:
+            self.reactor.tick()
+
+    def stop(self):
+        """Stop the thread, leaving the clients as they are."""
+
+        self.reactor.call_soon_threadsafe(setattr, self, 'running', False)
+        self.thread.join()
+
+    def add(self, key, client):
+        """Add client, known as key. Safe to call from any thread."""
+
+        self.reactor.call_soon_threadsafe(self._add, key, client)
+
+    def _add(self, key, client):
+        self.clients[key] = client
+        self.seen[key] = getattr(client, 'received', 0)
+        client.shard = self
+        self.reactor.addclient(client)
+
+    def remove(self, key, then=None, check=None):
+        """Remove the client known as key, and call then with key and
+        the client, on the shard thread. If check is given, the client
+        is only removed if check(client) is true there, otherwise then
+        gets None for the client. Without then, the client is removed
+        for good, and closed (See close). Safe to call from any thread."""
+
+        self.reactor.call_soon_threadsafe(self._remove, key, then, check)
+
+    def _remove(self, key, then, check):
+        client = self.clients.get(key)
+        if client is None:
+            return
+        if check is not None and not check(client):
+            if then is not None:
+                then(key, None)
+            return
+        del self.clients[key]
+        self.seen.pop(key, None)
+        if client in self.reactor.clients:
+            self.reactor.removeclient(client)
+        if then is not None:
+            then(key, client)
+        else:
+            close(client)
+
+    def send(self, key, line):
+        """Send line on the connection known as key, on any shard."""
+
+        self.supervisor.send(key, line)
+
+    def deliver(self, key, line):
+        """Write line on the client known as key, on this shard.
+        Safe to call from any thread."""
+
+        self.reactor.call_soon_threadsafe(self._deliver, key, line)
+
+    def _deliver(self, key, line):
+        client = self.clients.get(key)
+        if client is not None:
+            client.wline(line)
+        elif self.supervisor.where.get(key, self) is not self:
+            # It moved away while the line was on its way.
+            self.supervisor.send(key, line)
+
+    def sample(self):
+        """Work out the bytes per second each client received since
+        the last sample."""
+
+        rates = {}
+        for key, client in self.clients.items():
+            received = getattr(client, 'received', 0)
+            rates[key] = (received - self.seen[key]) / self.interval
+            self.seen[key] = received
+        self.rates = rates
+        self.load = sum(rates.values())
+
+class ProcessShard(object):
+    """A reactor running in a process of its own. The supervisor's
+    end of the pipe to it is a client of the supervisor's reactor."""
+
+    def __init__(self, supervisor, number, interval, factory):
+        """factory is called in the shard process with the spec given
+        to add, and returns a registered client."""
+
+        self.supervisor = supervisor
+        self.number = number
+        self.pipe, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=serve_shard, args=(child, number, interval, factory),
+            name='shard %d' % number)
+        self.process.daemon = True
+        self.load = 0.0
+        self.keys = set()
+
+    def start(self):
+        """Start the process."""
+
+        self.process.start()
+
+    def stop(self):
+        """Stop the process."""
+
+        self.pipe.send(('stop',))
+        self.process.join()
+
+    def add(self, key, spec):
+        """Make a client from spec in the shard, known as key."""
+
+        self.pipe.send(('add', key, spec))
+
+    def remove(self, key):
+        """Remove the client known as key."""
+
+        self.pipe.send(('remove', key))
+
+    def deliver(self, key, line):
+        """Write line on the client known as key, in the shard."""
+
+        self.pipe.send(('send', key, line))
+
+    def id(self):
+        """Return fd of the pipe."""
+
+        return self.pipe.fileno()
+
+    def do_io(self):
+        """Read what the shard has to say: its load, and lines
+        for connections on other shards."""
+
+        while self.pipe.poll():
+            try:
+                message = self.pipe.recv()
+            except EOFError:
+                raise IOError('Shard %d went away' % self.number)
+            if message[0] == 'load':
+                self.load = message[1]
+            elif message[0] == 'route':
+                self.supervisor.send(message[1], message[2])
+
+    def retry(self):
+        """A dead shard stays dead."""
+
+        return False
+
+class ShardLink(object):
+    """The shard process' end of the pipe to the supervisor, and
+    what the clients in the shard see as their shard."""
+
+    def __init__(self, pipe, reactor, interval, factory):
+        self.pipe = pipe
+        self.reactor = reactor
+        self.interval = interval
+        self.factory = factory
+        self.clients = {}
+        self.seen = 0
+        self.running = True
+
+    def id(self):
+        """Return fd of the pipe."""
+
+        return self.pipe.fileno()
+
+    def do_io(self):
+        """Do what the supervisor says."""
+
+        while self.pipe.poll():
+            try:
+                message = self.pipe.recv()
+            except EOFError:
+                self.running = False
+                return
+            action, args = message[0], message[1:]
+            if action == 'add':
+                key, spec = args
+                client = self.factory(spec)
+                client.shard = self
+                self.clients[key] = client
+                self.reactor.addclient(client)
+            elif action == 'remove':
+                client = self.clients.pop(args[0], None)
+                if client is not None:
+                    if client in self.reactor.clients:
+                        self.reactor.removeclient(client)
+                    close(client)
+            elif action == 'send':
+                client = self.clients.get(args[0])
+                if client is not None:
+                    client.wline(args[1])
+            elif action == 'stop':
+                self.running = False
+
+    def retry(self):
+        """Without the supervisor, there's nothing to do."""
+
+        self.running = False
+        return False
+
+    def send(self, key, line):
+        """Send line on the connection known as key, on any shard."""
+
+        client = self.clients.get(key)
+        if client is not None:
+            client.wline(line)
+        else:
+            self.pipe.send(('route', key, line))
+
+    def sample(self):
+        """Tell the supervisor how many bytes per second the
+        clients received since the last sample."""
+
+        received = sum(getattr(client, 'received', 0)
+                       for client in self.clients.values())
+        self.pipe.send(('load', (received - self.seen) / self.interval))
+        self.seen = received
+
+def serve_shard(pipe, number, interval, factory):
+    """Run a shard, in its own process."""
+
+    reactor = Reactor(name='shard%d' % number)
+    link = ShardLink(pipe, reactor, interval, factory)
+    reactor.addclient(link)
+    reactor.call_every(interval, link.sample)
+    while link.running:
+        reactor.tick()
+
+class Supervisor(object):
+    """Starts shards and spreads connections over them.
+
+    The supervisor has a reactor of its own, which loop runs, to
+    hear from process shards and rebalance thread shards. Call add,
+    remove and move from that thread (Or before loop), or from any
+    thread through call. send may be called from any shard.
+    """
+
+    def __init__(self, shards=None, processes=False, factory=None,
+                 interval=5.0, ratio=2.0, logger=None):
+        """Start shards shards (Default: one per core), on processes
+        if processes is set, otherwise on threads. Process shards need
+        factory, see ProcessShard.
+
+        Traffic is measured every interval seconds, and thread shards
+        are rebalanced when one gets ratio times the traffic of another.
+        """
+
+        if shards is None:
+            shards = multiprocessing.cpu_count()
+        self.processes = processes
+        self.interval = interval
+        self.ratio = ratio
+        self.reactor = Reactor(logger=logger, name='supervisor')
+        self.where = {}
+        self.shards = []
+        for number in range(shards):
+            if processes:
+                shard = ProcessShard(self, number, interval, factory)
+            else:
+                shard = ThreadShard(self, number, interval, logger)
+            shard.start()
+            if processes:
+                self.reactor.addclient(shard)
+            self.shards.append(shard)
+        if not processes:
+            self.reactor.call_every(interval, self.rebalance)
+
+    def call(self, callback, *args):
+        """Run callback with args on the supervisor thread, soon.
+        Safe to call from any thread."""
+
+        self.reactor.call_soon_threadsafe(callback, *args)
+
+    def pick(self):
+        """The shard with the least traffic, then the fewest clients."""
+
+        return min(self.shards, key=lambda shard: (shard.load, len(shard.keys)))
+
+    def add(self, key, client):
+        """Add a client (Or, for process shards, a spec to make it from)
+        known as key, to the quietest shard. Returns the shard."""
+
+        if key in self.where:
+            raise KeyError('%r is already on a shard' % (key,))
+        shard = self.pick()
+        self.where[key] = shard
+        shard.keys.add(key)
+        shard.add(key, client)
+        return shard
+
+    def remove(self, key):
+        """Remove the client known as key from its shard, and close
+        it (See close)."""
+
+        shard = self.where.pop(key)
+        shard.keys.discard(key)
+        shard.remove(key)
+
+    def send(self, key, line):
+        """Send line on the connection known as key, whatever shard it
+        is on. Lines for unknown keys are dropped."""
+
+        shard = self.where.get(key)
+        if shard is not None:
+            shard.deliver(key, line)
+
+    def move(self, key, shard):
+        """Move the client known as key to shard (Thread shards only),
+        if it's still movable (See movable) when the shard it's on gets
+        to it."""
+
+        source = self.where[key]
+        if source is shard:
+            return
+        source.keys.discard(key)
+        shard.keys.add(key)
+
+        def arrive(key, client):
+            if client is None:
+                self.call(self.unmove, key, source, shard)
+            else:
+                self.call(self.land, key, client, source, shard)
+        source.remove(key, arrive, movable)
+
+    def land(self, key, client, source, shard):
+        """The client known as key left source for shard. If it was
+        removed on the way, it's closed instead."""
+
+        if self.where.get(key) is not source:
+            shard.keys.discard(key)
+            close(client)
+            return
+        self.where[key] = shard
+        shard.add(key, client)
+
+    def unmove(self, key, source, shard):
+        """The client known as key didn't move from source to shard."""
+
+        shard.keys.discard(key)
+        if self.where.get(key) is not source:
+            # Removed (And closed, by source) meanwhile.
+            return
+        source.keys.add(key)
+        shard.load -= source.rates.get(key, 0)
+        source.load += source.rates.get(key, 0)
+
+    def rebalance(self):
+        """Move a client from the busiest thread shard to the quietest,
+        if the busiest has ratio times the traffic of the quietest. The
+        client moved is the one that evens them out best. Whether it
+        can move is up to its shard (See movable and move), as only
+        the shard may look at its clients."""
+
+        busiest = max(self.shards, key=lambda shard: shard.load)
+        quietest = min(self.shards, key=lambda shard: shard.load)
+        if busiest is quietest or busiest.load <= self.ratio * quietest.load:
+            return
+        gap = (busiest.load - quietest.load) / 2
+        candidates = [(abs(gap - rate), key) for key, rate in busiest.rates.items()
+                      if 0 < rate < 2 * gap and key in busiest.keys]
+        if candidates:
+            key = min(candidates)[1]
+            rate = busiest.rates[key]
+            self.move(key, quietest)
+            # Until the next sample, assume the traffic moved with it.
+            busiest.load -= rate
+            quietest.load += rate
+
+    def loop(self):
+        """Loop indefinitely, running the supervisor's reactor."""
+
+        while True:
+            self.reactor.tick()
+
+    def stop(self):
+        """Stop the shards."""
+
+        for shard in self.shards:
+            shard.stop()
@@ -0,0 +1,356 @@
+"""
+This module keeps track of the channels a client is in, who else is
+in them, and with what modes, from the lines the server sends.
+
+An irc.IRCProtocol has a Tracker, updated from JOIN, PART, KICK, QUIT,
+NICK, MODE and TOPIC lines and the replies to NAMES and WHO before the
+handlers see the line, so handlers can ask it who is in a channel
+instead of sending NAMES and parsing the replies themselves.
+
+Nicks and channels are looked up by key: the name folded by the
+casemapping of the server and interned (See casemap), so every lookup
+is a dict lookup. Users are only kept while they share a channel with
+the client.
+"""
+
+from casemap import Casemap
+
+# Modes with a parameter, by default (Servers tell the truth in
+# ISUPPORT CHANMODES): lists, always, and only when set.
+LIST_MODES = 'beI'
+PARAM_MODES = 'k'
+SET_PARAM_MODES = 'l'
+# Channel modes given to members, and the prefixes showing them.
+PREFIXES = (('o', '@'), ('v', '+'))
+
+class User(object):
+    """Someone sharing a channel with the client."""
+
+    __slots__ = ('nick', 'user', 'host', 'realname', 'away', 'channels')
+
+    def __init__(self, nick):
+        self.nick = nick
+        self.user = self.host = self.realname = None
+        self.away = False
+        # Keys of the channels they're in.
+        self.channels = set()
+
+    def __repr__(self):
+        return '<User %s!%s@%s>' % (self.nick, self.user, self.host)
+
+class Channel(object):
+    """A channel the client is in."""
+
+    __slots__ = ('name', 'topic', 'modes', 'members', 'synced')
+
+    def __init__(self, name):
+        self.name = name
+        self.topic = None
+        # Mode letter to parameter (None for flags).
+        self.modes = {}
+        # Key of each member to the letters of their modes, like 'o'.
+        self.members = {}
+        # True once the NAMES reply after joining is complete.
+        self.synced = False
+
+    def __repr__(self):
+        return '<Channel %s (%d members)>' % (self.name, len(self.members))
+
+class Tracker(object):
+    """Channels and users, as seen from lines from the server."""
+
+    def __init__(self, fold=None):
+        """fold turns a nick or channel into its key, it's
+        a casemap.Casemap by default."""
+
+        if fold is None:
+            fold = Casemap()
+        self.fold = fold
+        self.me = self.mekey = None
+        self.users = {}
+        self.channels = {}
+        self.chanmodes = (LIST_MODES, PARAM_MODES, SET_PARAM_MODES)
+        self.set_prefixes(PREFIXES)
+        self.updates = {
+            'JOIN': self.joined,
+            'PART': self.parted,
+            'KICK': self.kicked,
+            'QUIT': self.quit,
+            'NICK': self.renamed,
+            'MODE': self.mode,
+            'TOPIC': self.topic,
+            'RPL_TOPIC': self.rpl_topic,
+            'RPL_NAMREPLY': self.namreply,
+            'RPL_ENDOFNAMES': self.endofnames,
+            'RPL_WHOREPLY': self.whoreply,
+            }
+
+    def set_prefixes(self, prefixes):
+        """Use prefixes, pairs of (mode, prefix) like ('o', '@'),
+        highest first, for the modes given to members."""
+
+        self.prefixes = tuple(prefixes)
+        self.prefix_modes = dict((prefix, mode) for mode, prefix in prefixes)
+        self.member_modes = ''.join(mode for mode, prefix in prefixes)
+
+    def set_chanmodes(self, lists, params, set_params):
+        """Use these mode letters for modes with a parameter: lists
+        (Like bans), those that always have one, and those that have
+        one only when set."""
+
+        self.chanmodes = (lists, params, set_params)
+
+    def set_fold(self, fold):
+        """Turn names into keys with fold from now on. Forgets
+        everything, as the keys may have changed."""
+
+        self.fold = fold
+        self.me = self.mekey = None
+        self.reset()
+
+    def reset(self):
+        """Forget everything, as when the connection is lost."""
+
+        self.users.clear()
+        self.channels.clear()
+
+    def update(self, line, me):
+        """Update from line (An irc.ParsedLine). me is the
+        current nick of the client."""
+
+        update = self.updates.get(line.command())
+        if update is not None and line.args:
+            if me != self.me:
+                self.me, self.mekey = me, self.fold(me or '')
+            update(line, self.mekey)
+
+    # Lookups.
+
+    def channel(self, name):
+        """The Channel called name, or None if we're not in it."""
+
+        return self.channels.get(self.fold(name))
+
+    def user(self, nick):
+        """The User called nick, or None if we share no channel."""
+
+        return self.users.get(self.fold(nick))
+
+    def members(self, channel):
+        """The nicks in channel."""
+
+        found = self.channel(channel)
+        if found is None:
+            return []
+        users = self.users
+        return [users[key].nick for key in found.members]
+
+    def modes(self, channel, nick):
+        """The mode letters nick has in channel, like 'ov', or None
+        if nick isn't there."""
+
+        found = self.channel(channel)
+        if found is None:
+            return None
+        return found.members.get(self.fold(nick))
+
+    def is_op(self, channel, nick):
+        """Does nick have ops in channel?"""
+
+        return 'o' in (self.modes(channel, nick) or '')
+
+    def is_voiced(self, channel, nick):
+        """Does nick have voice in channel?"""
+
+        return 'v' in (self.modes(channel, nick) or '')
+
+    def common_channels(self, nick):
+        """The names of the channels we share with nick."""
+
+        user = self.user(nick)
+        if user is None:
+            return []
+        return [self.channels[key].name for key in user.channels]
+
+    # Bookkeeping.
+
+    def add_member(self, channel, nick, modes=''):
+        """Note that nick is in channel (A Channel) with modes.
+        Returns the User."""
+
+        key = self.fold(nick)
+        user = self.users.get(key)
+        if user is None:
+            user = self.users[key] = User(intern(nick))
+        user.channels.add(self.fold(channel.name))
+        channel.members[key] = modes
+        return user
+
+    def remove_member(self, chankey, key):
+        """Take the user with key out of the channel with chankey,
+        and forget them if that was the last channel we shared."""
+
+        channel = self.channels.get(chankey)
+        if channel is not None:
+            channel.members.pop(key, None)
+        user = self.users.get(key)
+        if user is not None:
+            user.channels.discard(chankey)
+            if not user.channels:
+                del self.users[key]
+
+    def leave(self, chankey):
+        """We're no longer in the channel with chankey."""
+
+        channel = self.channels.pop(chankey, None)
+        if channel is None:
+            return
+        for key in channel.members:
+            user = self.users.get(key)
+            if user is not None:
+                user.channels.discard(chankey)
+                if not user.channels:
+                    del self.users[key]
+
+    # Updates, by command.
+
+    def joined(self, line, me):
+        chankey = self.fold(line.args[0])
+        key = self.fold(line.nickname)
+        channel = self.channels.get(chankey)
+        if key == me and channel is None:
+            channel = self.channels[chankey] = Channel(intern(line.args[0]))
+        if channel is None:
+            return
+        user = self.add_member(channel, line.nickname)
+        user.user, user.host = line.user or user.user, line.host or user.host
+        if len(line.args) > 2:
+            # extended-join: account and realname.
+            user.realname = line.args[2]
+
+    def parted(self, line, me):
+        for name in line.args[0].split(','):
+            chankey = self.fold(name)
+            if self.fold(line.nickname) == me:
+                self.leave(chankey)
+            else:
+                self.remove_member(chankey, self.fold(line.nickname))
+
+    def kicked(self, line, me):
+        if len(line.args) < 2:
+            return
+        chankey = self.fold(line.args[0])
+        if self.fold(line.args[1]) == me:
+            self.leave(chankey)
+        else:
+            self.remove_member(chankey, self.fold(line.args[1]))
+
+    def quit(self, line, me):
+        key = self.fold(line.nickname)
+        user = self.users.get(key)
+        if user is None:
+            return
+        for chankey in list(user.channels):
+            self.remove_member(chankey, key)
+
+    def renamed(self, line, me):
+        old, new = self.fold(line.nickname), self.fold(line.args[0])
+        user = self.users.pop(old, None)
+        if user is None:
+            return
+        user.nick = intern(line.args[0])
+        self.users[new] = user
+        for chankey in user.channels:
+            members = self.channels[chankey].members
+            members[new] = members.pop(old, '')
+
+    def mode(self, line, me):
+        channel = self.channels.get(self.fold(line.args[0]))
+        if channel is None or len(line.args) < 2:
+            return
+        lists, params, set_params = self.chanmodes
+        args = iter(line.args[2:])
+        adding = True
+        for letter in line.args[1]:
+            if letter == '+':
+                adding = True
+            elif letter == '-':
+                adding = False
+            elif letter in self.member_modes:
+                key = self.fold(next(args, ''))
+                modes = channel.members.get(key)
+                if modes is None:
+                    continue
+                if adding and letter not in modes:
+                    modes = ''.join(mode for mode in self.member_modes
+                                    if mode in modes or mode == letter)
+                elif not adding:
+                    modes = modes.replace(letter, '')
+                channel.members[key] = intern(modes)
+            elif letter in lists:
+                next(args, None)
+            elif letter in params or letter in set_params and adding:
+                value = next(args, None)
+                if adding:
+                    channel.modes[letter] = value
+                else:
+                    channel.modes.pop(letter, None)
+            elif adding:
+                channel.modes[letter] = None
+            else:
+                channel.modes.pop(letter, None)
+
+    def topic(self, line, me):
+        channel = self.channels.get(self.fold(line.args[0]))
+        if channel is not None:
+            channel.topic = line.message()
+
+    def rpl_topic(self, line, me):
+        if len(line.args) > 2:
+            channel = self.channels.get(self.fold(line.args[1]))
+            if channel is not None:
+                channel.topic = line.args[2]
+
+    def namreply(self, line, me):
+        # me = #channel :names, or me #channel :names on old servers.
+        if len(line.args) < 3:
+            return
+        channel = self.channels.get(self.fold(line.args[-2]))
+        if channel is None or channel.synced:
+            # We asked for the names of a channel we're not in, or
+            # already know; the caller will deal with the reply.
+            return
+        prefix_modes = self.prefix_modes
+        for name in line.args[-1].split():
+            modes = ''
+            while name and name[0] in prefix_modes:
+                modes += prefix_modes[name[0]]
+                name = name[1:]
+            # userhost-in-names.
+            nick, _, mask = name.partition('!')
+            user = self.add_member(channel, nick, intern(modes))
+            if mask:
+                user.user, _, user.host = mask.partition('@')
+
+    def endofnames(self, line, me):
+        if len(line.args) > 1:
+            channel = self.channels.get(self.fold(line.args[1]))
+            if channel is not None:
+                channel.synced = True
+
+    def whoreply(self, line, me):
+        # me channel user host server nick flags :hops realname
+        if len(line.args) < 8:
+            return
+        user = self.users.get(self.fold(line.args[5]))
+        if user is None:
+            return
+        user.user, user.host = line.args[2], line.args[3]
+        flags = line.args[6]
+        user.away = flags.startswith('G')
+        user.realname = line.args[7].partition(' ')[2]
+        chankey = self.fold(line.args[1])
+        if chankey in user.channels:
+            modes = ''.join(self.prefix_modes[char] for char in flags[1:]
+                            if char in self.prefix_modes)
+            self.channels[chankey].members[self.fold(user.nick)] = intern(modes)
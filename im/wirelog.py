@@ -0,0 +1,323 @@
+"""
+This module provides a structured, append-only log of the lines a
+client sends and receives, and a tool to query it.
+
+Records are written to segment files (000000.seg, 000001.seg, ...)
+in a directory. Each record is length-prefixed and holds the time,
+the connection, the direction and the fields of the line as parsed by
+irc.ParsedLine. An index of a segment (by time, nick and target) is
+written next to it by the indexer, and queries memory-map the
+segments, so only the records that match are read.
+
+To record, pass a WireLog to irc.IRCProtocol.set_wirelog. To index
+and query, run:
+
+python wirelog.py index DIRECTORY
+python wirelog.py query DIRECTORY [--nick NICK] [--target TARGET]
+                                  [--command COMMAND]
+                                  [--since TIME] [--until TIME]
+
+where TIME is like 2010-05-17 or 2010-05-17 14:30.
+"""
+
+import os
+import sys
+import mmap
+import time
+import struct
+import bisect
+import cPickle
+import optparse
+from array import array
+
+from irc import ParsedLine
+
+MAGIC = 'ANYWLOG1'
+IN = '<'
+OUT = '>'
+HEADER = struct.Struct('<IdB')
+FIELD = struct.Struct('<H')
+FIELDS = ('conn', 'nick', 'user', 'host', 'command', 'target', 'line')
+TARGETED = ('PRIVMSG', 'NOTICE', 'TOPIC', 'JOIN', 'PART', 'KICK', 'MODE')
+
+def encode(value):
+    """value as a str, shortened to fit in a field."""
+
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value[:0xffff]
+
+class Record(object):
+    """A record read back from a segment."""
+
+    __slots__ = ('time', 'direction') + FIELDS
+
+    def __str__(self):
+        """The record as a line of text."""
+
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.time))
+        return '%s %s %s %s' % (stamp, self.conn, self.direction, self.line)
+
+class WireLog(object):
+    """Appends records to the segments in a directory."""
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024):
+        """Write to directory, starting a new segment when the
+        current one grows past segment_bytes."""
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        numbers = segment_numbers(directory)
+        if numbers:
+            self.number = numbers[-1]
+        else:
+            self.number = 0
+        self.open()
+
+    def open(self):
+        """Open the current segment for appending."""
+
+        path = segment_path(self.directory, self.number)
+        self.segment = open(path, 'ab')
+        if not self.segment.tell():
+            self.segment.write(MAGIC)
+
+    def record(self, conn, direction, line, parsed=None):
+        """Append line, sent (OUT) or received (IN) on conn. parsed
+        is line as an irc.ParsedLine, if the caller has one."""
+
+        if parsed is None:
+            parsed = ParsedLine(line)
+        command = parsed.command()
+        if command in TARGETED and parsed.args:
+            target = parsed.args[0]
+        else:
+            target = ''
+        fields = [encode(value) for value in
+                  (conn, parsed.nickname, parsed.user, parsed.host,
+                   command, target, line)]
+        body = ''.join(FIELD.pack(len(value)) + value for value in fields)
+        self.segment.write(HEADER.pack(len(body), time.time(), ord(direction)) + body)
+        if self.segment.tell() >= self.segment_bytes:
+            self.segment.close()
+            self.number += 1
+            self.open()
+
+    def flush(self):
+        """Flush the current segment to disk."""
+
+        self.segment.flush()
+
+    def close(self):
+        """Close the current segment."""
+
+        self.segment.close()
+
+def segment_path(directory, number):
+    """Path of segment number in directory."""
+
+    return os.path.join(directory, '%06d.seg' % number)
+
+def segment_numbers(directory):
+    """Sorted numbers of the segments in directory."""
+
+    return sorted(int(name[:-4]) for name in os.listdir(directory)
+                  if name.endswith('.seg') and name[:-4].isdigit())
+
+def read_record(data, offset):
+    """Read the record at offset in data (A str or mmap).
+    Returns the record and the offset of the next one."""
+
+    length, when, direction = HEADER.unpack_from(data, offset)
+    record = Record()
+    record.time = when
+    record.direction = chr(direction)
+    pos = offset + HEADER.size
+    for name in FIELDS:
+        size, = FIELD.unpack_from(data, pos)
+        pos += FIELD.size
+        setattr(record, name, data[pos:pos + size])
+        pos += size
+    return record, offset + HEADER.size + length
+
+def scan(data, start=len(MAGIC), end=None):
+    """Yield (offset, record) for the records in data."""
+
+    if end is None:
+        end = len(data)
+    offset = start
+    while offset + HEADER.size <= end:
+        length = HEADER.unpack_from(data, offset)[0]
+        if offset + HEADER.size + length > end:
+            # Partially written, the writer is still at it.
+            break
+        record, following = read_record(data, offset)
+        yield offset, record
+        offset = following
+
+def mapped(path):
+    """Memory-map the file at path read-only, or None if it's empty."""
+
+    with open(path, 'rb') as segment:
+        size = os.fstat(segment.fileno()).st_size
+        if size <= len(MAGIC):
+            return None
+        return mmap.mmap(segment.fileno(), size, access=mmap.ACCESS_READ)
+
+class Index(object):
+    """Offsets of the records in a segment, by time, nick and target."""
+
+    def __init__(self):
+        """Make an empty index."""
+
+        self.size = 0
+        self.times = array('d')
+        self.offsets = array('L')
+        self.nicks = {}
+        self.targets = {}
+
+    def add(self, offset, record):
+        """Index record, found at offset."""
+
+        self.times.append(record.time)
+        self.offsets.append(offset)
+        if record.nick:
+            self.nicks.setdefault(record.nick.lower(), array('L')).append(offset)
+        if record.target:
+            self.targets.setdefault(record.target.lower(), array('L')).append(offset)
+
+    def between(self, since, until):
+        """Offsets of the records from since up to until, either may be None.
+        Records are written in order, so times is sorted."""
+
+        start, end = 0, len(self.times)
+        if since is not None:
+            start = bisect.bisect_left(self.times, since)
+        if until is not None:
+            end = bisect.bisect_right(self.times, until)
+        return self.offsets[start:end]
+
+def index_path(directory, number):
+    """Path of the index of segment number in directory."""
+
+    return os.path.join(directory, '%06d.idx' % number)
+
+def build_index(directory, number):
+    """Index segment number in directory, and write the index."""
+
+    index = Index()
+    path = segment_path(directory, number)
+    index.size = os.path.getsize(path)
+    data = mapped(path)
+    if data is not None:
+        for offset, record in scan(data, end=index.size):
+            index.add(offset, record)
+        data.close()
+    with open(index_path(directory, number), 'wb') as out:
+        cPickle.dump(index.__dict__, out, 2)
+    return index
+
+def load_index(directory, number):
+    """The index of segment number in directory, if it exists and covers
+    the whole segment, otherwise None."""
+
+    path = index_path(directory, number)
+    if not os.path.exists(path):
+        return None
+    index = Index()
+    with open(path, 'rb') as stored:
+        index.__dict__.update(cPickle.load(stored))
+    if index.size != os.path.getsize(segment_path(directory, number)):
+        return None
+    return index
+
+def query(directory, nick=None, target=None, command=None, since=None, until=None):
+    """Yield the records in directory matching all the given criteria.
+    Indexed segments only read the records the index points to,
+    others are scanned."""
+
+    if nick is not None:
+        nick = nick.lower()
+    if target is not None:
+        target = target.lower()
+    for number in segment_numbers(directory):
+        data = mapped(segment_path(directory, number))
+        if data is None:
+            continue
+        index = load_index(directory, number)
+        if index is None:
+            candidates = (offset for offset, record in scan(data))
+        else:
+            if index.times and (since is not None and index.times[-1] < since or
+                                until is not None and index.times[0] > until):
+                data.close()
+                continue
+            candidates = index.between(since, until)
+            if candidates:
+                # Records are in time order, so the records in the time
+                # range are the ones between these offsets.
+                first, last = candidates[0], candidates[-1]
+                tables = [table.get(key, ()) for key, table in
+                          ((nick, index.nicks), (target, index.targets))
+                          if key is not None]
+                if tables:
+                    offsets = min(tables, key=len)
+                    candidates = offsets[bisect.bisect_left(offsets, first):
+                                         bisect.bisect_right(offsets, last)]
+        for offset in candidates:
+            record = read_record(data, offset)[0]
+            if nick is not None and record.nick.lower() != nick:
+                continue
+            if target is not None and record.target.lower() != target:
+                continue
+            if command is not None and record.command != command:
+                continue
+            if since is not None and record.time < since:
+                continue
+            if until is not None and record.time > until:
+                continue
+            yield record
+        data.close()
+
+def parse_time(text):
+    """Seconds since the epoch for text like 2010-05-17 or 2010-05-17 14:30."""
+
+    for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(text, format))
+        except ValueError:
+            pass
+    raise ValueError('Unknown time format: %s' % text)
+
+def main(args):
+    """Index or query a wire log directory."""
+
+    parser = optparse.OptionParser(usage='%prog index|query DIRECTORY [options]')
+    parser.add_option('--nick')
+    parser.add_option('--target')
+    parser.add_option('--command')
+    parser.add_option('--since')
+    parser.add_option('--until')
+    options, args = parser.parse_args(args)
+    if len(args) != 2 or args[0] not in ('index', 'query'):
+        parser.error('Need index or query, and a directory.')
+    action, directory = args
+    if action == 'index':
+        for number in segment_numbers(directory):
+            if load_index(directory, number) is None:
+                index = build_index(directory, number)
+                print '%s: %d records' % (segment_path(directory, number), len(index.offsets))
+        return
+    since = until = None
+    if options.since:
+        since = parse_time(options.since)
+    if options.until:
+        until = parse_time(options.until)
+    for record in query(directory, options.nick, options.target,
+                        options.command, since, until):
+        print record
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,220 @@
+"""
+This module lets slow handlers run outside the thread of the
+reactor, on a bounded pool of threads or processes, so a blocking
+or CPU-heavy plugin can't stop the client from answering PINGs.
+
+A handler opts in by having a true offload attribute, and may have:
+concurrency - the most calls of it that may run at once.
+timeout - seconds before its output is thrown away.
+Use it with irc.IRCProtocol.set_workers.
+
+While it runs, the handler gets a Recorder instead of the
+IRCProtocol. Calls to methods like reply and privmsg are recorded,
+and made on the reactor thread once the handler is done, in the order
+the lines arrived in. Process pools need handlers, lines and
+state that can be pickled.
+"""
+
+import copy
+import pickle
+import collections
+import traceback
+from multiprocessing.pool import ThreadPool, Pool
+
+class Recorder(object):
+    """Stands in for an IRCProtocol in a worker. Records the
+    method calls made on it, so they can be made for real later."""
+
+    def __init__(self, line):
+        """line is the line the handler was called for."""
+
+        self.line = line
+        self.calls = []
+
+    def __getattr__(self, name):
+        """Return a function recording calls to method name."""
+
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        def record(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+        return record
+
+def call_handler(handler, line, state):
+    """Run handler in a worker. Returns (calls, error), where
+    error is a formatted traceback or None."""
+
+    recorder = Recorder(line)
+    try:
+        handler.run(line, state, recorder)
+    except Exception:
+        return recorder.calls, traceback.format_exc()
+    return recorder.calls, None
+
+def call_in_process(handler, line, state):
+    """call_handler, for a process pool. (Which drops the output,
+    and never calls back, if it can't pickle it.)"""
+
+    calls, error = call_handler(handler, line, state)
+    try:
+        pickle.dumps(calls, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return [], traceback.format_exc()
+    return calls, error
+
+class Job(object):
+    """A call of a handler on a line, for a protocol."""
+
+    def __init__(self, protocol, handler, line):
+        """Remember what to run, and where the output goes."""
+
+        self.protocol = protocol
+        self.handler = handler
+        # The protocol sets line.cmdargs for each handler it considers,
+        # so the worker gets a copy of the line with this handler's.
+        self.cmdargs = line.cmdargs
+        self.line = copy.copy(line)
+        self.line.cmdargs = self.cmdargs
+        self.calls = None
+        self.done = False
+        self.expiry = None
+
+class WorkerPool(object):
+    """Runs offloaded handlers on a pool of workers.
+
+    Never has more than max_pending calls running or waiting, further
+    calls are dropped (And logged). The output of each protocol is
+    replayed in the order the calls were submitted.
+    """
+
+    def __init__(self, reactor, workers=4, processes=False,
+                 max_pending=100, timeout=None, logger=None):
+        """reactor is the selector.Reactor the protocols run on.
+        workers is the size of the pool, which is made of processes
+        if processes is set, otherwise of threads. timeout is the
+        default for handlers without a timeout attribute."""
+
+        if processes:
+            self.pool = Pool(workers)
+        else:
+            self.pool = ThreadPool(workers)
+        self.processes = processes
+        self.reactor = reactor
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.logger = logger
+        self.pending = 0
+        self.running = collections.defaultdict(int)
+        self.waiting = collections.defaultdict(collections.deque)
+        self.order = {}
+
+    def log(self, event):
+        """Log event."""
+
+        if self.logger:
+            self.logger(event)
+
+    def submit(self, protocol, handler, line):
+        """Run handler on line for protocol, when there's room for it.
+        Returns a true value if the call was accepted."""
+
+        if self.pending >= self.max_pending:
+            self.log('Worker pool full, dropping %r for %s' % (handler, line))
+            return False
+        job = Job(protocol, handler, line)
+        if self.processes:
+            # Pool.apply_async never calls back for arguments it can't
+            # pickle, which would hold up the protocol's output for good.
+            try:
+                pickle.dumps((handler, job.line, protocol.state),
+                             pickle.HIGHEST_PROTOCOL)
+            except Exception, err:
+                self.log("Can't pickle %r for %s, dropping it: %s"
+                         % (handler, line, err))
+                return False
+        self.pending += 1
+        self.order.setdefault(protocol, collections.deque()).append(job)
+        limit = getattr(handler, 'concurrency', None)
+        if limit is not None and self.running[handler] >= limit:
+            self.waiting[handler].append(job)
+        else:
+            self.start(job)
+        return True
+
+    def start(self, job):
+        """Hand job to the pool."""
+
+        handler = job.handler
+        self.running[handler] += 1
+        timeout = getattr(handler, 'timeout', self.timeout)
+        if timeout is not None:
+            job.expiry = self.reactor.call_later(timeout, self.expire, job)
+        call = call_in_process if self.processes else call_handler
+        self.pool.apply_async(call, (handler, job.line, job.protocol.state),
+                              callback=lambda result: self.reactor.call_soon_threadsafe(
+                                  self.finished, job, result))
+
+    def expire(self, job):
+        """job took too long, give up on its output."""
+
+        if not job.done:
+            self.log('%r timed out on %s' % (job.handler, job.line))
+            self.complete(job, [])
+
+    def finished(self, job, result):
+        """A worker is done with job. Runs on the reactor thread."""
+
+        if job.done:
+            # Timed out, already dealt with.
+            return
+        calls, error = result
+        if error is not None:
+            self.log(error)
+        self.complete(job, calls)
+
+    def complete(self, job, calls):
+        """Mark job as done, start the next waiting call of its
+        handler and replay output that's no longer held up by
+        earlier jobs."""
+
+        job.done = True
+        job.calls = calls
+        if job.expiry is not None:
+            job.expiry.cancel()
+        self.pending -= 1
+        handler = job.handler
+        self.running[handler] -= 1
+        if not self.running[handler]:
+            del self.running[handler]
+        waiting = self.waiting.get(handler)
+        if waiting:
+            self.start(waiting.popleft())
+            if not waiting:
+                del self.waiting[handler]
+        order = self.order[job.protocol]
+        while order and order[0].done:
+            self.replay(order.popleft())
+        if not order:
+            del self.order[job.protocol]
+
+    def replay(self, job):
+        """Make the calls job recorded, with protocol.line set to the
+        line it ran on, so reply and nreply answer the right person."""
+
+        protocol = job.protocol
+        current = getattr(protocol, 'line', None)
+        protocol.line = job.line
+        try:
+            for name, args, kwargs in job.calls:
+                try:
+                    getattr(protocol, name)(*args, **kwargs)
+                except Exception, err:
+                    self.log(err)
+        finally:
+            protocol.line = current
+
+    def close(self):
+        """Stop the workers, once they're done."""
+
+        self.pool.close()